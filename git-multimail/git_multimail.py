@@ -51,7 +51,6 @@ See the accompanying README file for the complete documentation.
 import sys
 import os
 import re
-import bisect
 import socket
 import subprocess
 import shlex
@@ -64,10 +63,35 @@ except ImportError:
     # Python < 2.6 do not have ssl, but that's OK if we don't use it.
     pass
 import time
+import threading
+import hashlib
+import io
+import json
+import array
+import struct
+import signal
+import stat
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where multimailhook.detach is not supported.
+    fcntl = None
+try:
+    import sqlite3
+except ImportError:
+    # Python can be built without sqlite3, which is only needed for
+    # multimailhook.cacheFile.
+    sqlite3 = None
 
 import uuid
 import base64
 
+try:
+    import queue
+except ImportError:
+    # Python 2:
+    import Queue as queue
+
 PYTHON3 = sys.version_info >= (3, 0)
 
 if sys.version_info <= (2, 5):
@@ -264,6 +288,21 @@ refer to them.  Any revisions marked "discard" are gone forever.
 """
 
 
+REBASED_REVISIONS_TEMPLATE = """\
+The revisions listed above as "rebased" are new to this repository,
+but make the same changes as revisions that were removed from this
+%(refname_type)s; they will not be described in separate emails.
+"""
+
+
+ANNOUNCED_REVISIONS_TEMPLATE = """\
+The revisions listed above as "notified" are new to this repository,
+but were already described in emails sent to the same recipients
+(e.g., when they were pushed to another repository); they will not be
+described in separate emails again.
+"""
+
+
 NO_NEW_REVISIONS_TEMPLATE = """\
 No new revisions were added by this update.
 """
@@ -402,6 +441,45 @@ in repository %(repo_shortname)s.
 COMBINED_FOOTER_TEMPLATE = FOOTER_TEMPLATE
 
 
+# Digest of the new commits of a change having too many of them to
+# send one email per commit (see multimailhook.maxCommitEmailsAction)
+DIGEST_HEADER_TEMPLATE = """\
+Date: %(send_date)s
+To: %(recipients)s
+Subject: %(emailprefix)s%(refname_type)s %(short_refname)s: %(tot)s new commits
+MIME-Version: 1.0
+Content-Type: text/%(contenttype)s; charset=%(charset)s
+Content-Transfer-Encoding: 8bit
+From: %(fromaddr)s
+Reply-To: %(reply_to)s
+In-Reply-To: %(reply_to_msgid)s
+References: %(reply_to_msgid)s
+Thread-Index: %(thread_index)s
+X-Git-Host: %(fqdn)s
+X-Git-Repo: %(repo_shortname)s
+X-Git-Refname: %(refname)s
+X-Git-Reftype: %(refname_type)s
+X-Git-Oldrev: %(oldrev)s
+X-Git-Newrev: %(newrev)s
+X-Git-NotificationType: digest
+X-Git-Multimail-Version: %(multimail_version)s
+Auto-Submitted: auto-generated
+"""
+
+DIGEST_INTRO_TEMPLATE = """\
+This is an automated email from the git hooks/post-receive script.
+
+%(pusher)s pushed %(tot)s new commits to %(refname_type)s %(short_refname)s
+in repository %(repo_shortname)s.
+
+As this is more than %(max_commit_emails)s commits, they are summarized
+below instead of being described in separate emails.
+
+"""
+
+DIGEST_FOOTER_TEMPLATE = FOOTER_TEMPLATE
+
+
 class CommandError(Exception):
     def __init__(self, cmd, retcode):
         self.cmd = cmd
@@ -446,13 +524,148 @@ def choose_git_command():
             GIT_CMD = [GIT_EXECUTABLE]
 
 
+class GitOutputCache(object):
+    """Remember the output of git commands that only depend on objects.
+
+    The same git queries are often run several times while handling a
+    push (e.g., the summary of a commit can be needed in several
+    emails).  The output of a command is remembered if running it
+    again would give the same output: the command must be one of
+    COMMANDS, it must not use options that read references, and all
+    of its revision arguments, and each line of its input, must name
+    objects by their full SHA-1 (reference names can change at any
+    time, but objects cannot).  The output also depends on the
+    repository and on the configuration given on the command line, so
+    they are part of the key.  The outputs remembered are limited to
+    MAX_SIZE characters in total, and are forgotten at the end of each
+    push (see clear()).  The cache can be used by several threads (see
+    multimailhook.renderJobs)."""
+
+    COMMANDS = set(['cat-file', 'diff-tree', 'log', 'rev-list', 'rev-parse', 'show'])
+
+    # Options that make a command read references:
+    REF_OPTIONS = [
+        '--all', '--alternate-refs', '--bisect', '--branches', '--exclude',
+        '--glob', '--indexed-objects', '--merge', '--reflog', '--remotes',
+        '--tags', '--walk-reflogs', '-g',
+        ]
+
+    # A revision naming an object by its full SHA-1, possibly followed
+    # by suffixes like "^0", "~2" or "^{commit}":
+    OBJECT_RE = re.compile(
+        r'^\^?[0-9a-f]{40}(?:[0-9a-f]{24})?(?:\^\d*|~\d*|\^\{\w*\})*$'
+        )
+
+    MAX_SIZE = 64 * 1024 * 1024
+
+    # The environment variables that select the repository or change
+    # its configuration:
+    ENVIRONMENT_VARIABLES = [
+        'GIT_DIR', 'GIT_OBJECT_DIRECTORY', 'GIT_ALTERNATE_OBJECT_DIRECTORIES',
+        'GIT_CONFIG_PARAMETERS',
+        ]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Forget all the outputs remembered, and reset the statistics."""
+
+        with self._lock:
+            self._entries = {}
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+            self.time_saved = 0.0
+
+    @classmethod
+    def _is_object_arg(klass, arg):
+        return all(
+            klass.OBJECT_RE.match(rev)
+            for rev in re.split(r'\.\.\.?', arg)
+            )
+
+    @classmethod
+    def get_key(klass, args, input, keepends, kw):
+        """Return the key under which to remember the output of a command.
+
+        Return None if the output of the command must not be
+        remembered."""
+
+        if not args or args[0] not in klass.COMMANDS:
+            return None
+        if [k for k in kw if k != 'errors']:
+            return None
+        has_objects = False
+        for arg in args[1:]:
+            if arg.startswith('-'):
+                if [o for o in klass.REF_OPTIONS
+                        if arg == o or arg.startswith(o + '=')]:
+                    return None
+            elif klass._is_object_arg(arg):
+                has_objects = True
+            else:
+                return None
+        if input:
+            if not all(klass._is_object_arg(line) for line in input.splitlines()):
+                return None
+            has_objects = True
+        if not has_objects:
+            return None
+        repository = tuple(
+            [os.getcwd()] +
+            [os.environ.get(name) for name in klass.ENVIRONMENT_VARIABLES]
+            )
+        return (repository, tuple(args), input, keepends, kw.get('errors'))
+
+    def get(self, key):
+        """Return the output remembered for key, or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            (out, elapsed) = entry
+            self.time_saved += elapsed
+            return out
+
+    def put(self, key, out, elapsed):
+        with self._lock:
+            if key not in self._entries and self._size + len(out) <= self.MAX_SIZE:
+                self._entries[key] = (out, elapsed)
+                self._size += len(out)
+
+    def get_stats(self):
+        return '%d hits, %d misses, %.3fs saved' % (
+            self.hits, self.misses, self.time_saved,
+            )
+
+
+# The GitOutputCache used by read_git_output().
+GIT_OUTPUT_CACHE = GitOutputCache()
+
+
 def read_git_output(args, input=None, keepends=False, **kw):
-    """Read the output of a Git command."""
+    """Read the output of a Git command.
+
+    The output of commands that only depend on objects is remembered
+    (see GitOutputCache)."""
 
     if GIT_CMD is None:
         choose_git_command()
 
-    return read_output(GIT_CMD + args, input=input, keepends=keepends, **kw)
+    key = GitOutputCache.get_key(args, input, keepends, kw)
+    if key is None:
+        return read_output(GIT_CMD + args, input=input, keepends=keepends, **kw)
+    out = GIT_OUTPUT_CACHE.get(key)
+    if out is None:
+        start = time.time()
+        out = read_output(GIT_CMD + args, input=input, keepends=keepends, **kw)
+        GIT_OUTPUT_CACHE.put(key, out, time.time() - start)
+    return out
 
 
 def read_output(cmd, input=None, keepends=False, **kw):
@@ -487,26 +700,162 @@ def read_git_lines(args, keepends=False, **kw):
     return read_git_output(args, keepends=True, **kw).splitlines(keepends)
 
 
-def git_rev_list_ish(cmd, spec, args=None, **kw):
+def cut_utf8(data, size):
+    """Return the first size bytes of data, without splitting a character.
+
+    data is UTF-8 encoded; a character that would be split is
+    dropped."""
+
+    end = min(size, len(data))
+    if end < len(data):
+        while end > 0 and (ord(data[end:end + 1]) & 0xC0) == 0x80:
+            end -= 1
+    return data[:end]
+
+
+def iter_raw_lines(fd, max_bytes=None, chunk_size=65536):
+    """Iterate over the lines read from the file descriptor fd, as bytes.
+
+    The data is read in chunks of at most chunk_size bytes, and each
+    line (including its newline) is yielded once it is complete.  If
+    max_bytes is not None, only the first max_bytes bytes of longer
+    lines (see cut_utf8()) and their newline are kept, so that the
+    memory used does not depend on the length of the lines."""
+
+    pending = []
+    size = 0
+    truncated = False
+    while True:
+        chunk = os.read(fd, chunk_size)
+        if not chunk:
+            break
+        start = 0
+        while start < len(chunk):
+            end = chunk.find(b'\n', start) + 1
+            if end:
+                complete = True
+            else:
+                end = len(chunk)
+                complete = False
+            if not truncated:
+                pending.append(chunk[start:end])
+                size += end - start
+                if max_bytes is not None and size > max_bytes:
+                    pending = [cut_utf8(b''.join(pending), max_bytes)]
+                    truncated = True
+            if complete:
+                if truncated:
+                    pending.append(b'\n')
+                yield b''.join(pending)
+                pending = []
+                size = 0
+                truncated = False
+            start = end
+    if pending:
+        yield b''.join(pending)
+
+
+def iter_output(cmd, input=None, keepends=False, errors='strict', max_line_length=None, **kw):
+    """Iterate over the lines output by cmd while it is running.
+
+    Unlike read_output(), the output is never held in memory as a
+    whole: it is read from the pipe in fixed-size chunks and decoded a
+    line at a time.  Lines are split the same way as by
+    read_git_lines().  If max_line_length is not None, longer lines
+    are cut without being read into memory as a whole; they keep more
+    than max_line_length characters, so that limit_linelength() still
+    marks them as truncated.  Once all of the output has been read,
+    raise CommandError if the command failed.  If the caller stops
+    iterating early, the command is terminated."""
+
+    if input:
+        stdin = subprocess.PIPE
+    else:
+        stdin = None
+    devnull = open(os.devnull, 'wb')
+    try:
+        p = subprocess.Popen(
+            tuple(str_to_bytes(w) for w in cmd),
+            stdin=stdin, stdout=subprocess.PIPE, stderr=devnull, bufsize=0,
+            **kw
+            )
+    finally:
+        devnull.close()
+    try:
+        if input:
+            # The commands we run read all of their input before
+            # producing any output, so this cannot deadlock:
+            try:
+                p.stdin.write(str_to_bytes(input))
+                p.stdin.close()
+            except (IOError, OSError):
+                # The command died early; its exit status tells why.
+                pass
+        if max_line_length:
+            # Enough bytes for max_line_length + 1 characters of up to
+            # 4 bytes each in UTF-8:
+            max_bytes = 4 * (max_line_length + 2)
+        else:
+            max_bytes = None
+        for raw_line in iter_raw_lines(p.stdout.fileno(), max_bytes):
+            for line in bytes_to_str(raw_line, errors=errors).splitlines(keepends):
+                yield line
+        p.stdout.close()
+        retcode = p.wait()
+        if retcode:
+            raise CommandError(cmd, retcode)
+    finally:
+        if p.returncode is None:
+            try:
+                p.terminate()
+            except OSError:
+                pass
+            p.stdout.close()
+            p.wait()
+
+
+def iter_git_lines(args, keepends=False, **kw):
+    """Iterate over the lines output by Git command, as they arrive.
+
+    See iter_output() for details."""
+
+    if GIT_CMD is None:
+        choose_git_command()
+
+    return iter_output(GIT_CMD + args, keepends=keepends, **kw)
+
+
+def git_rev_list_ish(cmd, spec, args=None, stream=False, **kw):
     """Common functionality for invoking a 'git rev-list'-like command.
 
     Parameters:
       * cmd is the Git command to run, e.g., 'rev-list' or 'log'.
       * spec is a list of revision arguments to pass to the named
         command.  If None, this function returns an empty list.
+        Revision options (e.g., "--not", "--exclude=...",
+        "--glob=...") can be included.
       * args is a list of extra arguments passed to the named command.
+      * If stream is true, the output is read with iter_git_lines()
+        instead of read_git_lines().
       * All other keyword arguments (if any) are passed to the
-        underlying read_git_lines() function.
+        underlying read_git_lines() or iter_git_lines() function.
 
-    Return the output of the Git command in the form of a list, one
-    entry per output line.
+    Return the output of the Git command in the form of a list (or,
+    if stream is true, an iterator), one entry per output line.
     """
     if spec is None:
         return []
     if args is None:
         args = []
-    args = [cmd, '--stdin'] + args
-    spec_stdin = ''.join(s + '\n' for s in spec)
+    # "git rev-list --stdin" does not accept options like "--not" or
+    # "--glob" on its input, so pass them on the command line.  The
+    # revisions read from stdin are not affected by a "--not" option
+    # given on the command line.
+    options = [s for s in spec if s.startswith('--')]
+    args = [cmd] + args + options + ['--stdin']
+    spec_stdin = ''.join(s + '\n' for s in spec if not s.startswith('--'))
+    if stream:
+        return iter_git_lines(args, input=spec_stdin, **kw)
     return read_git_lines(args, input=spec_stdin, **kw)
 
 
@@ -528,6 +877,170 @@ def git_log(spec, **kw):
     return git_rev_list_ish('log', spec, **kw)
 
 
+class CatFileBatch(object):
+    """Long-running "git cat-file" processes answering object queries.
+
+    Running "git cat-file" or "git rev-parse" once per object costs a
+    fork/exec per query.  Instead, keep a "git cat-file --batch-check"
+    process (for object types and sizes) and a "git cat-file --batch"
+    process (for object contents) running, and talk to them over
+    pipes.  Each process is started the first time it is needed.
+
+    The query methods accept anything that "git cat-file" accepts as
+    an object name (e.g., "<sha1>^0").  They return None if the object
+    does not exist, and raise CommandError if the process could not be
+    run or stopped responding; in that case, callers should fall back
+    to one-shot git commands."""
+
+    def __init__(self):
+        if GIT_CMD is None:
+            choose_git_command()
+        # Map from cat-file option to its process, or to None if the
+        # process failed and must not be used anymore:
+        self._processes = {}
+
+    def _get_process(self, option):
+        cmd = GIT_CMD + ['cat-file', option]
+        if option in self._processes:
+            p = self._processes[option]
+            if p is None:
+                raise CommandError(cmd, None)
+            return p
+        devnull = open(os.devnull, 'wb')
+        try:
+            p = subprocess.Popen(
+                tuple(str_to_bytes(w) for w in cmd),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull,
+                bufsize=-1,
+                )
+        except OSError:
+            self._processes[option] = None
+            raise CommandError(cmd, None)
+        finally:
+            devnull.close()
+        self._processes[option] = p
+        return p
+
+    def _fail(self, option):
+        p = self._processes[option]
+        self._processes[option] = None
+        self._stop(p)
+        raise CommandError(GIT_CMD + ['cat-file', option], p.poll())
+
+    @staticmethod
+    def _stop(p):
+        try:
+            p.stdin.close()
+        except (IOError, OSError):
+            pass
+        p.stdout.close()
+        p.wait()
+
+    def _query(self, option, name):
+        """Send name to the process; return (process, header words) or None."""
+
+        if '\n' in name:
+            return None
+        p = self._get_process(option)
+        try:
+            p.stdin.write(str_to_bytes(name + '\n'))
+            p.stdin.flush()
+            header = p.stdout.readline()
+        except (IOError, OSError):
+            header = b''
+        if not header.endswith(b'\n'):
+            self._fail(option)
+        words = bytes_to_str(header).split()
+        # The output is "<sha1> <type> <size>" for existing objects,
+        # and "<name> missing" or "<name> ambiguous" otherwise.
+        if len(words) != 3 or not words[2].isdigit():
+            return None
+        return (p, words)
+
+    def info(self, name):
+        """Return (sha1, type, size) for the object called name."""
+
+        result = self._query('--batch-check', name)
+        if result is None:
+            return None
+        (p, [sha1, type, size]) = result
+        return (sha1, type, int(size))
+
+    def contents(self, name, errors='strict'):
+        """Return (sha1, type, contents) for the object called name.
+
+        contents is the raw content of the object as a string."""
+
+        result = self._query('--batch', name)
+        if result is None:
+            return None
+        (p, [sha1, type, size]) = result
+        # The contents are followed by a LF:
+        size = int(size) + 1
+        try:
+            data = p.stdout.read(size)
+        except (IOError, OSError):
+            data = b''
+        if len(data) != size:
+            self._fail('--batch')
+        return (sha1, type, bytes_to_str(data[:-1], errors=errors))
+
+    def close(self):
+        for (option, p) in list(self._processes.items()):
+            if p is not None:
+                self._stop(p)
+                del self._processes[option]
+
+
+# The CatFileBatch shared by all object queries.  It is created by
+# get_cat_file_batch() when first needed, and its processes are
+# stopped by close_cat_file_batch() once the push has been handled.
+CAT_FILE_BATCH = None
+
+
+def get_cat_file_batch():
+    global CAT_FILE_BATCH
+
+    if CAT_FILE_BATCH is None:
+        CAT_FILE_BATCH = CatFileBatch()
+    return CAT_FILE_BATCH
+
+
+def close_cat_file_batch():
+    global CAT_FILE_BATCH
+
+    if CAT_FILE_BATCH is not None:
+        CAT_FILE_BATCH.close()
+        CAT_FILE_BATCH = None
+
+
+def read_object_info(name):
+    """Return (sha1, type, size) for the object called name.
+
+    Return None if the object does not exist or if the shared
+    "git cat-file --batch-check" process cannot be used; callers
+    should then fall back to a one-shot git command, which also
+    reports errors the usual way."""
+
+    try:
+        return get_cat_file_batch().info(name)
+    except CommandError:
+        return None
+
+
+def read_object_contents(name, errors='strict'):
+    """Return (sha1, type, contents) for the object called name.
+
+    Return None if the object does not exist or if the shared
+    "git cat-file --batch" process cannot be used (see
+    read_object_info())."""
+
+    try:
+        return get_cat_file_batch().contents(name, errors=errors)
+    except CommandError:
+        return None
+
+
 def header_encode(text, header_name=None):
     """Encode and line-wrap the value of an email header field."""
 
@@ -571,7 +1084,12 @@ class Config(object):
         If git_config is specified, it is passed to "git config" in
         the GIT_CONFIG environment variable, meaning that "git config"
         will read the specified path rather than the Git default
-        config paths."""
+        config paths.
+
+        The whole configuration is read with a single "git config
+        --list" call the first time a value is needed, and lookups are
+        then served from memory.  The snapshot is discarded whenever
+        the configuration is modified through this object."""
 
         self.section = section
         if git_config:
@@ -579,6 +1097,8 @@ class Config(object):
             self.env['GIT_CONFIG'] = git_config
         else:
             self.env = None
+        self._values = None
+        self._values_parameters = None
 
     @staticmethod
     def _split(s):
@@ -588,6 +1108,19 @@ class Config(object):
         assert words[-1] == ''
         return words[:-1]
 
+    @staticmethod
+    def _canonicalize(key):
+        """Return key in the form used by "git config --list".
+
+        Section and variable names are case-insensitive and are
+        reported in lower case, whereas subsection names are
+        case-sensitive."""
+
+        words = key.split('.')
+        words[0] = words[0].lower()
+        words[-1] = words[-1].lower()
+        return '.'.join(words)
+
     @staticmethod
     def add_config_parameters(c):
         """Add configuration parameters to Git.
@@ -610,26 +1143,120 @@ class Config(object):
         parameters += ' '.join("'" + x.replace("'", "'\\''") + "'" for x in c)
         os.environ['GIT_CONFIG_PARAMETERS'] = parameters
 
-    def get(self, name, default=None):
+    @staticmethod
+    def parse_bool(value):
+        """Interpret value as a boolean, the way "git config --bool" does.
+
+        value is None for a variable that is given without "=" (which
+        means true).  Raise ValueError if value is not a boolean."""
+
+        if value is None:
+            return True
+        lowered = value.lower()
+        if lowered in ('true', 'yes', 'on'):
+            return True
+        if lowered in ('false', 'no', 'off', ''):
+            return False
+        return Config.parse_int(value) != 0
+
+    INT_RE = re.compile(
+        r'^\s*(?P<sign>[-+]?)(?P<number>0[xX][0-9a-fA-F]+|0[0-7]*|[1-9][0-9]*)'
+        r'(?P<unit>[kKmMgG]?)$'
+        )
+
+    UNIT_FACTORS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+    @staticmethod
+    def parse_int(value):
+        """Interpret value as an integer, the way "git config --int" does.
+
+        Like git, accept decimal, octal and hexadecimal numbers with an
+        optional "k", "m" or "g" unit suffix.  Raise ValueError if
+        value is not an integer."""
+
+        m = value is not None and Config.INT_RE.match(value)
+        if not m:
+            raise ValueError('invalid integer value %r' % (value,))
+        number = m.group('number')
+        if number[:2] in ('0x', '0X'):
+            number = int(number[2:], 16)
+        elif number.startswith('0'):
+            number = int(number, 8)
+        else:
+            number = int(number)
+        number *= Config.UNIT_FACTORS[m.group('unit').lower()]
+        if m.group('sign') == '-':
+            number = -number
+        return number
+
+    def _get_values(self, name):
+        """Return the list of values of name, or None if it is unset.
+
+        Variables given without "=" are represented as None in the
+        list."""
+
+        parameters = os.environ.get('GIT_CONFIG_PARAMETERS')
+        if self._values is None or parameters != self._values_parameters:
+            self._values = self._read_values()
+            self._values_parameters = parameters
+        return self._values.get(self._canonicalize('%s.%s' % (self.section, name)))
+
+    def _read_values(self):
+        """Read the variables of this section with one "git config" call.
+
+        Return a dict mapping canonical keys to lists of values."""
+
         try:
-            values = self._split(read_git_output(
-                ['config', '--get', '--null', '%s.%s' % (self.section, name)],
+            entries = self._split(read_git_output(
+                ['config', '--list', '--null'],
                 env=self.env, keepends=True,
                 ))
-            assert len(values) == 1
-            return values[0]
         except CommandError:
+            # No configuration could be read at all (e.g., GIT_CONFIG
+            # names a file that doesn't exist); treat everything as
+            # unset.
+            entries = []
+
+        prefix = self._canonicalize(self.section + '.x')[:-1]
+        values = {}
+        for entry in entries:
+            # Each entry is the key, followed by a newline and the
+            # value unless the key was given without "=":
+            if '\n' in entry:
+                (key, value) = entry.split('\n', 1)
+            else:
+                (key, value) = (entry, None)
+            key = self._canonicalize(key)
+            if key.startswith(prefix):
+                values.setdefault(key, []).append(value)
+        return values
+
+    def get(self, name, default=None):
+        values = self._get_values(name)
+        if values is None:
             return default
+        # As with "git config --get", the last value wins:
+        return values[-1] or ''
 
     def get_bool(self, name, default=None):
+        values = self._get_values(name)
+        if values is None:
+            return default
         try:
-            value = read_git_output(
-                ['config', '--get', '--bool', '%s.%s' % (self.section, name)],
-                env=self.env,
-                )
-        except CommandError:
+            return self.parse_bool(values[-1])
+        except ValueError:
             return default
-        return value == 'true'
+
+    def get_int(self, name, default=None):
+        """Read an integer setting from the configuration.
+
+        Return default if the name is unset, and raise ValueError if
+        the value is not an integer."""
+
+        values = self._get_values(name)
+        if values is None:
+            return default
+        return self.parse_int(values[-1])
 
     def get_all(self, name, default=None):
         """Read a (possibly multivalued) setting from the configuration.
@@ -637,27 +1264,20 @@ class Config(object):
         Return the result as a list of values, or default if the name
         is unset."""
 
-        try:
-            return self._split(read_git_output(
-                ['config', '--get-all', '--null', '%s.%s' % (self.section, name)],
-                env=self.env, keepends=True,
-                ))
-        except CommandError:
-            t, e, traceback = sys.exc_info()
-            if e.retcode == 1:
-                # "the section or key is invalid"; i.e., there is no
-                # value for the specified key.
-                return default
-            else:
-                raise
+        values = self._get_values(name)
+        if values is None:
+            return default
+        return [value or '' for value in values]
 
     def set(self, name, value):
+        self._values = None
         read_git_output(
             ['config', '%s.%s' % (self.section, name), value],
             env=self.env,
             )
 
     def add(self, name, value):
+        self._values = None
         read_git_output(
             ['config', '--add', '%s.%s' % (self.section, name), value],
             env=self.env,
@@ -672,6 +1292,7 @@ class Config(object):
         return name in self
 
     def unset_all(self, name):
+        self._values = None
         try:
             read_git_output(
                 ['config', '--unset-all', '%s.%s' % (self.section, name)],
@@ -695,93 +1316,630 @@ def generate_summaries(*log_args):
     """Generate a brief summary for each revision requested.
 
     log_args are strings that will be passed directly to "git log" as
-    revision selectors.  Iterate over (sha1_short, subject) for each
-    commit specified by log_args (subject is the first line of the
-    commit message as a string without EOLs)."""
+    revision selectors.  Iterate over (sha1, sha1_short, subject) for
+    each commit specified by log_args (subject is the first line of
+    the commit message as a string without EOLs)."""
 
     cmd = [
-        'log', '--abbrev', '--format=%h %s',
+        'log', '--abbrev', '--format=%H %h %s',
         ] + list(log_args) + ['--']
     for line in read_git_lines(cmd):
-        yield tuple(line.split(' ', 1))
-
+        words = line.split(' ', 2)
+        yield (words[0], words[1], words[2] if len(words) > 2 else '')
 
-def limit_lines(lines, max_lines):
-    for (index, line) in enumerate(lines):
-        if index < max_lines:
-            yield line
 
-    if index >= max_lines:
-        yield '... %d lines suppressed ...\n' % (index + 1 - max_lines,)
+def read_short_sha1s(objects):
+    """Read the abbreviated names of the commits among objects.
 
+    objects is an iterable of GitObjects.  The abbreviated names of
+    all the commits whose abbreviation is not known yet are read with
+    a single git command.  Other objects are abbreviated one by one
+    when needed (see GitObject.short)."""
 
-def limit_linelength(lines, max_linelength):
-    for line in lines:
-        # Don't forget that lines always include a trailing newline.
-        if len(line) > max_linelength + 1:
-            line = line[:max_linelength - 7] + ' [...]\n'
-        yield line
+    objects = [
+        o for o in objects
+        if o.type == 'commit' and o._short is None
+        ]
+    shorts = read_commit_abbrevs([o.sha1 for o in objects])
+    for o in objects:
+        o._short = shorts.get(o.sha1)
 
 
-class CommitSet(object):
-    """A (constant) set of object names.
+def read_commit_abbrevs(sha1s):
+    """Return a dict {sha1: sha1_short} for the commits named by sha1s.
 
-    The set should be initialized with full SHA1 object names.  The
-    __contains__() method returns True iff its argument is an
-    abbreviation of any the names in the set."""
+    All commits are abbreviated by a single git command."""
 
-    def __init__(self, names):
-        self._names = sorted(names)
+    if not sha1s:
+        return {}
+    shorts = {}
+    for line in read_git_lines(
+            ['log', '--no-walk', '--stdin', '--abbrev', '--format=%H %h'],
+            input=''.join(sha1 + '\n' for sha1 in sha1s),
+            ):
+        (sha1, short) = line.split(' ', 1)
+        shorts[sha1] = short
+    return shorts
+
+
+def read_left_right_summaries(left, right):
+    """Summarize the commits that differ between left and right.
+
+    Return (lefts, rights), the lists of (sha1, sha1_short, subject)
+    for the commits reachable from left but not from right, and from
+    right but not from left, in topological order (children first).
+    Both lists are produced by a single walk of the history."""
+
+    lefts = []
+    rights = []
+    for line in iter_git_lines([
+            'log', '--left-right', '--topo-order', '--abbrev', '--format=%m %H %h %s',
+            '%s...%s' % (left, right), '--',
+            ]):
+        words = line.split(' ', 3)
+        summary = (words[1], words[2], words[3] if len(words) > 3 else '')
+        if words[0] == '<':
+            lefts.append(summary)
+        else:
+            rights.append(summary)
+    return (lefts, rights)
 
-    def __len__(self):
-        return len(self._names)
 
-    def __contains__(self, sha1_abbrev):
-        """Return True iff this set contains sha1_abbrev (which might be abbreviated)."""
+def read_patch_ids(sha1s):
+    """Return a dict {sha1: patch_id} for the commits named by sha1s.
 
-        i = bisect.bisect_left(self._names, sha1_abbrev)
-        return i < len(self) and self._names[i].startswith(sha1_abbrev)
+    The stable patch ids (see "git patch-id --stable") of all the
+    commits are computed by a single "git diff-tree --stdin -p | git
+    patch-id --stable" pipeline.  Merges and commits that change
+    nothing have no patch id."""
 
+    sha1s = list(sha1s)
+    if not sha1s:
+        return {}
+    if GIT_CMD is None:
+        choose_git_command()
 
-class GitObject(object):
-    def __init__(self, sha1, type=None):
-        if sha1 == ZEROS:
-            self.sha1 = self.type = self.commit_sha1 = None
-        else:
-            self.sha1 = sha1
-            self.type = type or read_git_output(['cat-file', '-t', self.sha1])
+    diff_cmd = GIT_CMD + ['diff-tree', '--stdin', '--root', '-p']
+    patch_id_cmd = GIT_CMD + ['patch-id', '--stable']
+    devnull = open(os.devnull, 'wb')
+    try:
+        diff = subprocess.Popen(
+            tuple(str_to_bytes(w) for w in diff_cmd),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull,
+            )
+        try:
+            patch_ids_process = subprocess.Popen(
+                tuple(str_to_bytes(w) for w in patch_id_cmd),
+                stdin=diff.stdout, stdout=subprocess.PIPE, stderr=devnull,
+                )
+        except OSError:
+            diff.stdin.close()
+            diff.stdout.close()
+            diff.wait()
+            raise
+    finally:
+        devnull.close()
+    diff.stdout.close()
 
-            if self.type == 'commit':
-                self.commit_sha1 = self.sha1
-            elif self.type == 'tag':
-                try:
-                    self.commit_sha1 = read_git_output(
-                        ['rev-parse', '--verify', '%s^0' % (self.sha1,)]
-                        )
-                except CommandError:
-                    # Cannot deref tag to determine commit_sha1
-                    self.commit_sha1 = None
-            else:
-                self.commit_sha1 = None
+    # "git diff-tree --stdin" writes its output while it reads its
+    # input, so feed it from another thread to avoid a deadlock:
+    def feed():
+        try:
+            diff.stdin.write(str_to_bytes(''.join(sha1 + '\n' for sha1 in sha1s)))
+            diff.stdin.close()
+        except (IOError, OSError):
+            # The command died early; its exit status tells why.
+            pass
 
-        self.short = read_git_output(['rev-parse', '--short', sha1])
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    out = patch_ids_process.communicate()[0]
+    feeder.join()
+    for (p, cmd) in [(diff, diff_cmd), (patch_ids_process, patch_id_cmd)]:
+        retcode = p.wait()
+        if retcode:
+            raise CommandError(cmd, retcode)
+
+    patch_ids = {}
+    for line in bytes_to_str(out).splitlines():
+        (patch_id, sha1) = line.split()
+        patch_ids[sha1] = patch_id
+    return patch_ids
+
+
+class CommitInfo(object):
+    """The metadata of a commit that is needed to describe it.
+
+    Instances are usually created by read_commit_infos(), which reads
+    the metadata of many commits at once."""
+
+    # The fields read for each commit, and the "git log" placeholder
+    # used to read each of them:
+    FIELDS = [
+        ('sha1', '%H'),
+        ('sha1_short', '%h'),
+        ('author', '%aN <%aE>'),
+        ('committer', '%cN'),
+        ('parents', '%P'),
+        ('subject', '%s'),
+        ('body', '%b'),
+        ]
 
-    def get_summary(self):
-        """Return (sha1_short, subject) for this commit."""
+    FORMAT = '%x00'.join(placeholder for (field, placeholder) in FIELDS)
 
-        if not self.sha1:
-            raise ValueError('Empty commit has no summary')
+    def __init__(self, sha1, sha1_short, author, committer, parents, subject, body):
+        self.sha1 = sha1
+        self.sha1_short = sha1_short
+        self.author = author
+        self.committer = committer
+        self.parents = parents.split()
+        self.subject = subject
+        self.body = body
 
-        return next(iter(generate_summaries('--no-walk', self.sha1)))
 
-    def __eq__(self, other):
-        return isinstance(other, GitObject) and self.sha1 == other.sha1
+def read_commit_infos(sha1s, cache=None):
+    """Read the metadata of the commits named by sha1s.
 
-    def __ne__(self, other):
-        return not self == other
+    All commits are read with a single "git log" invocation.  If cache
+    (a CommitInfoCache) is given, the commits found in it are not read
+    at all, and the others are added to it.  Return a dict {sha1:
+    CommitInfo}."""
 
-    def __hash__(self):
-        return hash(self.sha1)
+    sha1s = list(sha1s)
+    if not sha1s:
+        return {}
+
+    if cache is not None:
+        infos = cache.get(sha1s)
+        missing = read_commit_infos(
+            [sha1 for sha1 in sha1s if sha1 not in infos]
+            )
+        cache.put(missing.values())
+        infos.update(missing)
+        return infos
+
+    # With -z, each commit is terminated by a NUL character, so the
+    # output is a flat list of fields followed by an empty string:
+    fields = read_git_output(
+        ['log', '--no-walk', '--stdin', '-z', '--abbrev',
+         '--format=tformat:%s' % (CommitInfo.FORMAT,)],
+        input=''.join(sha1 + '\n' for sha1 in sha1s), keepends=True,
+        ).split('\0')
+    assert fields[-1] == ''
+    n = len(CommitInfo.FIELDS)
+    infos = {}
+    for i in range(0, len(fields) - 1, n):
+        info = CommitInfo(*fields[i:i + n])
+        infos[info.sha1] = info
+    return infos
+
+
+def read_commit_numstats(sha1s, cache=None):
+    """Read the numbers of lines changed by the commits named by sha1s.
+
+    The numstat of a commit is the output of "git log --numstat" for
+    it: one "added\tdeleted\tpath" line per changed file (with "-"
+    instead of the numbers for binary files), which also gives the
+    size of its patch.  All commits are read with a single "git log"
+    invocation.  If cache (a CommitInfoCache) is given, the commits
+    found in it are not read at all, and the others are added to it.
+    Return a dict {sha1: numstat}."""
+
+    sha1s = list(sha1s)
+    if not sha1s:
+        return {}
+
+    if cache is not None:
+        numstats = cache.get_numstats(sha1s)
+        missing = read_commit_numstats(
+            [sha1 for sha1 in sha1s if sha1 not in numstats]
+            )
+        cache.put_numstats(missing)
+        numstats.update(missing)
+        return numstats
+
+    # Each commit is a line with its sha1, followed by its numstat
+    # lines, which (unlike the sha1) contain tabs:
+    lines = {}
+    sha1 = None
+    for line in iter_git_lines(
+            ['log', '--no-walk', '--stdin', '--format=%H', '--numstat'],
+            input=''.join(sha1 + '\n' for sha1 in sha1s),
+            ):
+        if '\t' in line:
+            lines[sha1].append(line + '\n')
+        elif line:
+            sha1 = line
+            lines[sha1] = []
+    return dict((sha1, ''.join(lines[sha1])) for sha1 in lines)
+
+
+def get_mailmap_key():
+    """Return a string identifying the repository and its mailmap.
+
+    The abbreviated names of the commits depend on the repository,
+    and their authors and committers on its mailmap: the ".mailmap"
+    file at the top of its working tree, and the file and blob named
+    by mailmap.file and mailmap.blob (which defaults to "HEAD:.mailmap"
+    in bare repositories).  The key is made of the path of the
+    repository and of a hash of the settings and of the contents of
+    the mailmap, so that it changes whenever the mailmap does."""
+
+    config = Config('mailmap')
+    digest = hashlib.sha1()
+    paths = [config.get('file')]
+    blob = config.get('blob')
+    if read_git_output(['rev-parse', '--is-bare-repository']) == 'true':
+        if blob is None:
+            blob = 'HEAD:.mailmap'
+    else:
+        paths.append(os.path.join(
+            read_git_output(['rev-parse', '--show-toplevel']), '.mailmap'))
+    for path in paths:
+        if path is not None:
+            digest.update(str_to_bytes('file %s\n' % (path,)))
+            try:
+                with open(os.path.expanduser(path), 'rb') as f:
+                    digest.update(f.read())
+            except IOError:
+                pass
+    if blob is not None:
+        try:
+            blob_sha1 = read_git_output(['rev-parse', '--verify', '--quiet', blob])
+        except CommandError:
+            blob_sha1 = ''
+        digest.update(str_to_bytes('blob %s %s\n' % (blob, blob_sha1)))
+    return '%s %s' % (os.path.realpath(get_git_dir()), digest.hexdigest())
+
+
+def connect_sqlite(path, schema):
+    """Open the SQLite database at path, shared by concurrent hooks.
+
+    The database is used in WAL mode, so that it can be read while
+    another process writes to it, and the statements in schema are
+    run to create its tables if needed."""
+
+    db = sqlite3.connect(path, timeout=60)
+    if not PYTHON3:
+        # Read strings as they were written, as byte strings:
+        db.text_factory = str
+    db.execute('PRAGMA journal_mode=WAL')
+    with db:
+        for statement in schema:
+            db.execute(statement)
+    return db
+
+
+class CommitInfoCache(object):
+    """The CommitInfos and numstats of commits, kept between invocations.
+
+    The cache is an SQLite database (see multimailhook.cacheFile),
+    which can be shared by all the repositories of a server.  The
+    parents, message and numstat of a commit cannot change, so they
+    are kept once for all repositories and never need to be
+    invalidated; the subject and body do not depend on the repository
+    either, since git is always asked for them in the same encoding
+    (see choose_git_command()).  The abbreviated name of a commit
+    depends on the repository, and its author and committer on the
+    mailmap, so they are kept for each repository_key (see
+    get_mailmap_key()), which changes with the mailmap.  This way, a
+    commit found in the cache needs no git command at all.  (The
+    abbreviated name is the one computed when the commit was first
+    read, which may be shorter than git's current one if the
+    repository has grown a lot since.)  Hooks running at the same time
+    can use it (see connect_sqlite()).  When there are more than
+    max_entries commits, the least recently used ones are evicted."""
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS commits ('
+        ' sha1 TEXT PRIMARY KEY, parents TEXT, subject TEXT, body TEXT, numstat TEXT,'
+        ' used REAL)',
+        'CREATE INDEX IF NOT EXISTS commits_used ON commits (used)',
+        'CREATE TABLE IF NOT EXISTS commit_identities ('
+        ' repository TEXT, sha1 TEXT, sha1_short TEXT, author TEXT, committer TEXT,'
+        ' PRIMARY KEY (repository, sha1))',
+        'CREATE INDEX IF NOT EXISTS commit_identities_sha1 ON commit_identities (sha1)',
+        ]
+
+    # The maximum number of SQL variables in a query:
+    CHUNK_SIZE = 500
+
+    def __init__(self, path, max_entries, repository_key):
+        self.max_entries = max_entries
+        self.repository_key = repository_key
+        self._db = connect_sqlite(path, self.SCHEMA)
+
+    def _select(self, query, sha1s, params=()):
+        """Run query for the sha1s, in chunks, and iterate over the rows.
+
+        query must contain "%s" where the placeholders of the sha1s
+        go, after those of params."""
+
+        for i in range(0, len(sha1s), self.CHUNK_SIZE):
+            chunk = sha1s[i:i + self.CHUNK_SIZE]
+            for row in self._db.execute(
+                    query % (','.join('?' * len(chunk)),), list(params) + chunk,
+                    ):
+                yield row
+
+    def get(self, sha1s):
+        """Return a dict {sha1: CommitInfo} for the sha1s found in the cache.
+
+        Only the commits whose identities are known for
+        repository_key are returned."""
+
+        infos = {}
+        with self._db:
+            for row in self._select(
+                    'SELECT c.sha1, i.sha1_short, i.author, i.committer,'
+                    ' c.parents, c.subject, c.body'
+                    ' FROM commits c JOIN commit_identities i'
+                    ' ON i.sha1 = c.sha1 AND i.repository = ?'
+                    ' WHERE c.sha1 IN (%s)',
+                    sha1s, [self.repository_key],
+                    ):
+                infos[row[0]] = CommitInfo(*row)
+            now = time.time()
+            self._db.executemany(
+                'UPDATE commits SET used = ? WHERE sha1 = ?',
+                [(now, sha1) for sha1 in infos],
+                )
+        return infos
+
+    def put(self, infos):
+        """Add the CommitInfos in infos to the cache."""
+
+        infos = list(infos)
+        now = time.time()
+        with self._db:
+            # Keep the numstat of the commits already known:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO commits (sha1, parents, subject, body)'
+                ' VALUES (?, ?, ?, ?)',
+                [
+                    (info.sha1, ' '.join(info.parents), info.subject, info.body)
+                    for info in infos
+                    ],
+                )
+            self._db.executemany(
+                'UPDATE commits SET used = ? WHERE sha1 = ?',
+                [(now, info.sha1) for info in infos],
+                )
+            self._db.executemany(
+                'INSERT OR REPLACE INTO commit_identities VALUES (?, ?, ?, ?, ?)',
+                [
+                    (self.repository_key, info.sha1, info.sha1_short,
+                     info.author, info.committer)
+                    for info in infos
+                    ],
+                )
+            (count,) = self._db.execute('SELECT COUNT(*) FROM commits').fetchone()
+            if count > self.max_entries:
+                for table in ['commit_identities', 'commits']:
+                    self._db.execute(
+                        'DELETE FROM %s WHERE sha1 IN'
+                        ' (SELECT sha1 FROM commits ORDER BY used LIMIT ?)' % (table,),
+                        (count - self.max_entries,),
+                        )
+
+    def get_numstats(self, sha1s):
+        """Return a dict {sha1: numstat} for the sha1s found in the cache.
+
+        See read_commit_numstats()."""
+
+        with self._db:
+            return dict(self._select(
+                'SELECT sha1, numstat FROM commits'
+                ' WHERE numstat IS NOT NULL AND sha1 IN (%s)',
+                sha1s,
+                ))
+
+    def put_numstats(self, numstats):
+        """Add the numstats in numstats, a dict {sha1: numstat}, to the cache.
+
+        Only the numstats of the commits already in the cache (see
+        put()) are kept."""
+
+        with self._db:
+            self._db.executemany(
+                'UPDATE commits SET numstat = ? WHERE sha1 = ?',
+                [(numstat, sha1) for (sha1, numstat) in numstats.items()],
+                )
+
+    def close(self):
+        self._db.close()
+
+
+class AnnouncementRegistry(object):
+    """The commits already announced to each list of recipients.
+
+    The registry is an SQLite database (see
+    multimailhook.announcedCommitsFile), which can be shared by
+    repositories holding the same commits, like the forks of a
+    project, so that a commit emailed to a list because it was pushed
+    to one of them is not emailed to the same list again.
+
+    A commit is claimed for a list of recipients before its email is
+    sent, so that concurrent hooks do not both send it.  The claim is
+    only confirmed once the email is known to be delivered, i.e., when
+    the mailer is closed successfully (mailers like QueuedMailer only
+    queue the emails they are given); the claims of emails that could
+    not be delivered are released, and those left unconfirmed by an
+    interrupted hook expire after CLAIM_TIMEOUT seconds.  The
+    announcements older than max_age seconds are forgotten (see
+    prune())."""
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS announcements ('
+        ' recipients TEXT, sha1 TEXT, time REAL, confirmed INTEGER,'
+        ' PRIMARY KEY (recipients, sha1))',
+        'CREATE INDEX IF NOT EXISTS announcements_time ON announcements (time)',
+        ]
+
+    CLAIM_TIMEOUT = 24 * 3600
+
+    # The maximum number of SQL variables in a query:
+    CHUNK_SIZE = 500
+
+    def __init__(self, path, max_age):
+        self.max_age = max_age
+        self._db = connect_sqlite(path, self.SCHEMA)
+
+    @staticmethod
+    def get_key(recipients):
+        """Return the normalized form of the recipients string."""
+
+        return ', '.join(sorted(set(
+            address.lower()
+            for (name, address) in getaddresses([recipients])
+            if address
+            )))
+
+    def claim(self, recipients, sha1):
+        """Claim sha1 for an email to recipients.
+
+        Return False if it had already been announced to them, or is
+        claimed by another hook."""
+
+        key = self.get_key(recipients)
+        now = time.time()
+        with self._db:
+            cursor = self._db.execute(
+                'INSERT OR IGNORE INTO announcements VALUES (?, ?, ?, 0)',
+                (key, sha1, now),
+                )
+            if cursor.rowcount == 1:
+                return True
+            # Take over the claim of an interrupted hook:
+            cursor = self._db.execute(
+                'UPDATE announcements SET time = ?'
+                ' WHERE recipients = ? AND sha1 = ? AND NOT confirmed AND time < ?',
+                (now, key, sha1, now - self.CLAIM_TIMEOUT),
+                )
+            return cursor.rowcount == 1
+
+    def confirm(self, claims):
+        """Confirm the (recipients, sha1) pairs in claims."""
+
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                'UPDATE announcements SET confirmed = 1, time = ?'
+                ' WHERE recipients = ? AND sha1 = ?',
+                [(now, self.get_key(recipients), sha1) for (recipients, sha1) in claims],
+                )
+
+    def release(self, claims):
+        """Forget the (recipients, sha1) pairs in claims."""
+
+        with self._db:
+            self._db.executemany(
+                'DELETE FROM announcements WHERE recipients = ? AND sha1 = ? AND NOT confirmed',
+                [(self.get_key(recipients), sha1) for (recipients, sha1) in claims],
+                )
+
+    def prune(self):
+        """Forget the announcements older than max_age, and the expired claims."""
+
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                'DELETE FROM announcements WHERE time < ? OR (NOT confirmed AND time < ?)',
+                (now - self.max_age, now - self.CLAIM_TIMEOUT),
+                )
+
+    def close(self):
+        self._db.close()
+
+
+def limit_lines(lines, max_lines):
+    """Iterate over the first max_lines lines of lines.
+
+    If there are more lines, add a line saying so instead of reading
+    them: lines is closed, which terminates the git command producing
+    them (see iter_output())."""
+
+    lines = iter(lines)
+    for (index, line) in enumerate(lines):
+        if index >= max_lines:
+            yield '... remaining lines suppressed ...\n'
+            break
+        yield line
+
+    close = getattr(lines, 'close', None)
+    if close is not None:
+        close()
+
+
+def limit_linelength(lines, max_linelength):
+    for line in lines:
+        # Don't forget that lines always include a trailing newline.
+        if len(line) > max_linelength + 1:
+            line = line[:max_linelength - 7] + ' [...]\n'
+        yield line
+
+
+class GitObject(object):
+    def __init__(self, sha1, type=None, short=None):
+        if sha1 == ZEROS:
+            self.sha1 = self.type = self.commit_sha1 = None
+        else:
+            self.sha1 = sha1
+            if not type:
+                info = read_object_info(self.sha1)
+                if info:
+                    type = info[1]
+                else:
+                    type = read_git_output(['cat-file', '-t', self.sha1])
+            self.type = type
+
+            if self.type == 'commit':
+                self.commit_sha1 = self.sha1
+            elif self.type == 'tag':
+                info = read_object_info('%s^0' % (self.sha1,))
+                if info:
+                    self.commit_sha1 = info[0]
+                else:
+                    try:
+                        self.commit_sha1 = read_git_output(
+                            ['rev-parse', '--verify', '%s^0' % (self.sha1,)]
+                            )
+                    except CommandError:
+                        # Cannot deref tag to determine commit_sha1
+                        self.commit_sha1 = None
+            else:
+                self.commit_sha1 = None
+
+        # The abbreviated name of the object, if known already (see
+        # read_short_sha1s()):
+        self._short = short
+
+    @property
+    def short(self):
+        if self._short is None:
+            self._short = read_git_output(['rev-parse', '--short', str(self)])
+        return self._short
+
+    def get_summary(self):
+        """Return (sha1_short, subject) for this commit."""
+
+        if not self.sha1:
+            raise ValueError('Empty commit has no summary')
+
+        (sha1, sha1_short, subject) = next(iter(generate_summaries('--no-walk', self.sha1)))
+        if self._short is None:
+            self._short = sha1_short
+        return (sha1_short, subject)
+
+    def __eq__(self, other):
+        return isinstance(other, GitObject) and self.sha1 == other.sha1
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.sha1)
 
     def __nonzero__(self):
         return bool(self.sha1)
@@ -1066,7 +2224,15 @@ class Revision(Change):
 
     CC_RE = re.compile(r'^\s*C[Cc]:\s*(?P<to>[^#]+@[^\s#]*)\s*(#.*)?$')
 
-    def __init__(self, reference_change, rev, num, tot):
+    def __init__(self, reference_change, rev, num, tot, info=None):
+        """Create a Revision for the commit rev (a GitObject).
+
+        info is the CommitInfo of the commit, if it has already been
+        read (see Push.get_commit_infos()); otherwise it is read when
+        first needed.  The recipients are also only computed when
+        first needed, so that a Revision which is never emailed costs
+        nothing."""
+
         Change.__init__(self, reference_change.environment)
         self.reference_change = reference_change
         self.rev = rev
@@ -1074,24 +2240,58 @@ class Revision(Change):
         self.refname = self.reference_change.refname
         self.num = num
         self.tot = tot
-        self.author = read_git_output(['log', '--no-walk', '--format=%aN <%aE>', self.rev.sha1])
-        self.recipients = self.environment.get_revision_recipients(self)
+        self.__info = info
+        self.__recipients = None
+        self.__cc_recipients = None
+
+    @property
+    def info(self):
+        if self.__info is None:
+            self.__info = read_commit_infos([self.rev.sha1])[self.rev.sha1]
+        return self.__info
+
+    @property
+    def author(self):
+        return self.info.author
+
+    @property
+    def committer(self):
+        return self.info.committer
+
+    @property
+    def parents(self):
+        return self.info.parents
+
+    @property
+    def recipients(self):
+        if self.__recipients is None:
+            self.__recipients = self.environment.get_revision_recipients(self)
+        return self.__recipients
+
+    @recipients.setter
+    def recipients(self, value):
+        self.__recipients = value
 
-        # -s is short for --no-patch, but -s works on older git's (e.g. 1.7)
-        self.parents = read_git_lines(['show', '-s', '--format=%P',
-                                      self.rev.sha1])[0].split()
+    @property
+    def cc_recipients(self):
+        if self.__cc_recipients is None:
+            self.__cc_recipients = ''
+            if self.environment.get_scancommitforcc():
+                self.__cc_recipients = ', '.join(
+                    to.strip() for to in self._cc_recipients()
+                    )
+                if self.__cc_recipients:
+                    self.environment.log_msg(
+                        'Add %s to CC for %s' % (self.__cc_recipients, self.rev.sha1))
+        return self.__cc_recipients
 
-        self.cc_recipients = ''
-        if self.environment.get_scancommitforcc():
-            self.cc_recipients = ', '.join(to.strip() for to in self._cc_recipients())
-            if self.cc_recipients:
-                self.environment.log_msg(
-                    'Add %s to CC for %s' % (self.cc_recipients, self.rev.sha1))
+    @cc_recipients.setter
+    def cc_recipients(self, value):
+        self.__cc_recipients = value or ''
 
     def _cc_recipients(self):
         cc_recipients = []
-        message = read_git_output(['log', '--no-walk', '--format=%b', self.rev.sha1])
-        lines = message.strip().split('\n')
+        lines = self.info.body.strip().split('\n')
         for line in lines:
             m = re.match(self.CC_RE, line)
             if m:
@@ -1102,9 +2302,7 @@ class Revision(Change):
     def _compute_values(self):
         values = Change._compute_values(self)
 
-        oneline = read_git_output(
-            ['log', '--format=%s', '--no-walk', self.rev.sha1]
-            )
+        oneline = self.info.subject
 
         max_subject_length = self.environment.get_max_subject_length()
         if max_subject_length > 0 and len(oneline) > max_subject_length:
@@ -1165,10 +2363,7 @@ class Revision(Change):
     def generate_email_body(self, push):
         """Show this revision."""
 
-        for line in read_git_lines(
-                ['log'] + self.environment.commitlogopts + ['-1', self.rev.sha1],
-                keepends=True,
-                errors='replace'):
+        for line in push.generate_commit_log(self.rev.sha1):
             if line.startswith('Date:   ') and self.environment.date_substitute:
                 yield self.environment.date_substitute + line[len('Date:   '):]
             else:
@@ -1186,6 +2381,134 @@ class Revision(Change):
         return self.environment.from_commit
 
 
+class CommitDigest(Change):
+    """A Change consisting of the many new commits of a reference change.
+
+    When a reference change has more new commits than
+    multimailhook.maxCommitEmails, a single email summarizing them
+    can be sent instead of one email per commit.  It lists the
+    subjects of the commits grouped by author, like "git shortlog",
+    and the number of lines changed in each file by all of them.
+    Only the metadata of the commits, which Push reads anyway, the
+    numstats of NUMSTAT_CHUNK_SIZE commits and one line per changed
+    file are held in memory."""
+
+    # The number of commits whose numstats are read at once:
+    NUMSTAT_CHUNK_SIZE = 1000
+
+    def __init__(self, reference_change, sha1s, infos):
+        """Create a CommitDigest for the commits sha1s of reference_change.
+
+        sha1s are in chronological order; infos is a dict {sha1:
+        CommitInfo} for them."""
+
+        Change.__init__(self, reference_change.environment)
+        self.reference_change = reference_change
+        self.sha1s = sha1s
+        self.infos = infos
+        self.recipients = self.environment.get_digest_recipients(self)
+
+    def _compute_values(self):
+        values = Change._compute_values(self)
+
+        reference_values = self.reference_change.get_values()
+        for name in [
+                'refname', 'short_refname', 'refname_type', 'oldrev', 'newrev',
+                ]:
+            values[name] = reference_values[name]
+        values['reply_to_msgid'] = self.reference_change.msgid
+        values['thread_index'] = self.reference_change.thread_index
+        values['recipients'] = self.recipients
+        values['tot'] = len(self.sha1s)
+        values['max_commit_emails'] = self.environment.maxcommitemails
+
+        reply_to = self.environment.get_reply_to_refchange(self.reference_change)
+        if reply_to:
+            values['reply_to'] = reply_to
+
+        return values
+
+    def generate_email_header(self, **extra_values):
+        for line in self.expand_header_lines(
+                DIGEST_HEADER_TEMPLATE, **extra_values
+                ):
+            yield line
+
+    def generate_email_intro(self, html_escape_val=False):
+        for line in self.expand_lines(DIGEST_INTRO_TEMPLATE,
+                                      html_escape_val=html_escape_val):
+            yield line
+
+    def generate_shortlog(self):
+        """Generate the subjects of the commits, grouped by author."""
+
+        subjects = {}
+        for sha1 in self.sha1s:
+            info = self.infos[sha1]
+            subjects.setdefault(info.author, []).append(info.subject)
+        for author in sorted(subjects):
+            yield '%s (%d):\n' % (author, len(subjects[author]))
+            for subject in subjects[author]:
+                yield '      %s\n' % (subject,)
+            yield '\n'
+
+    def generate_diffstat(self, push):
+        """Generate the number of lines changed in each file by the commits.
+
+        The numstats of the commits are read in chunks (see
+        Push.get_commit_numstats()) and added up.  Binary files are
+        only listed."""
+
+        changes = {}
+        for i in range(0, len(self.sha1s), self.NUMSTAT_CHUNK_SIZE):
+            numstats = push.get_commit_numstats(self.sha1s[i:i + self.NUMSTAT_CHUNK_SIZE])
+            for numstat in numstats.values():
+                for line in numstat.splitlines():
+                    (added, deleted, path) = line.split('\t', 2)
+                    if added == '-':
+                        changes[path] = None
+                    else:
+                        (total_added, total_deleted) = changes.get(path) or (0, 0)
+                        changes[path] = (
+                            total_added + int(added), total_deleted + int(deleted),
+                            )
+
+        if not changes:
+            return
+        width = max(len(path) for path in changes)
+        total_added = total_deleted = 0
+        for path in sorted(changes):
+            if changes[path] is None:
+                yield ' %-*s | Bin\n' % (width, path)
+            else:
+                (added, deleted) = changes[path]
+                total_added += added
+                total_deleted += deleted
+                yield ' %-*s | +%d -%d\n' % (width, path, added, deleted)
+        yield ' %d file%s changed, %d insertion%s(+), %d deletion%s(-)\n' % (
+            len(changes), len(changes) != 1 and 's' or '',
+            total_added, total_added != 1 and 's' or '',
+            total_deleted, total_deleted != 1 and 's' or '',
+            )
+
+    def generate_email_body(self, push):
+        yield 'Summary of the new commits:\n'
+        yield '\n'
+        for line in self.generate_shortlog():
+            yield line
+        yield 'Changes made by the new commits:\n'
+        yield '\n'
+        for line in self.generate_diffstat(push):
+            yield line
+
+    def generate_email_footer(self, html_escape_val):
+        return self.expand_lines(DIGEST_FOOTER_TEMPLATE,
+                                 html_escape_val=html_escape_val)
+
+    def get_specific_fromaddr(self):
+        return self.environment.from_commit
+
+
 class ReferenceChange(Change):
     """A Change to a Git reference.
 
@@ -1335,13 +2658,14 @@ class ReferenceChange(Change):
 
         return values
 
-    def send_single_combined_email(self, known_added_sha1s):
+    def send_single_combined_email(self, known_added_sha1s, push=None):
         """Determine if a combined refchange/revision email should be sent
 
         If there is only a single new (non-merge) commit added by a
         change, it is useful to combine the ReferenceChange and
         Revision emails into one.  In such a case, return the single
-        revision; otherwise, return None.
+        revision; otherwise, return None.  If push is not None, it is
+        used to look up the metadata of the revision.
 
         This method is overridden in BranchChange."""
 
@@ -1412,7 +2736,10 @@ class ReferenceChange(Change):
             for newold in ('new', 'old'):
                 has_newold = False
                 spec = push.get_commits_spec(newold, self)
-                for line in git_log(spec, args=args, keepends=True):
+                for line in git_log(
+                        spec, args=args, stream=True, keepends=True,
+                        max_line_length=self.environment.get_email_max_line_length(),
+                        ):
                     if not has_newold:
                         has_newold = True
                         yield '\n'
@@ -1426,18 +2753,20 @@ class ReferenceChange(Change):
         if self.showlog:
             yield '\n'
             yield 'Detailed log of new commits:\n\n'
-            for line in read_git_lines(
+            for line in iter_git_lines(
                     ['log', '--no-walk'] +
                     self.logopts +
                     new_commits_list +
                     ['--'],
                     keepends=True,
+                    max_line_length=self.environment.get_email_max_line_length(),
                     ):
                 yield line
 
     def generate_new_revision_summary(self, tot, new_commits_list, push):
-        for line in self.expand_lines(NEW_REVISIONS_TEMPLATE, tot=tot):
-            yield line
+        if tot:
+            for line in self.expand_lines(NEW_REVISIONS_TEMPLATE, tot=tot):
+                yield line
         for line in self.generate_revision_change_graph(push):
             yield line
         for line in self.generate_revision_change_log(new_commits_list):
@@ -1453,23 +2782,31 @@ class ReferenceChange(Change):
             # change).
             sha1s = list(push.get_new_commits(self))
             sha1s.reverse()
-            tot = len(sha1s)
-            new_revisions = [
-                Revision(self, GitObject(sha1), num=i + 1, tot=tot)
-                for (i, sha1) in enumerate(sha1s)
-                ]
 
-            if new_revisions:
+            if sha1s:
+                # The summary lines only need the abbreviated name and
+                # subject of each commit, which are read for all of
+                # them at once (and reused for the commit emails):
+                infos = push.get_commit_infos(sha1s)
+                announced = push.get_announced_commits(self, sha1s)
                 yield self.expand('This %(refname_type)s includes the following new commits:\n')
                 yield '\n'
-                for r in new_revisions:
-                    (sha1, subject) = r.rev.get_summary()
-                    yield r.expand(
-                        BRIEF_SUMMARY_TEMPLATE, action='new', text=subject,
+                for sha1 in sha1s:
+                    if sha1 in announced:
+                        action = 'notified'
+                    else:
+                        action = 'new'
+                    yield self.expand(
+                        BRIEF_SUMMARY_TEMPLATE, action=action,
+                        rev_short=infos[sha1].sha1_short, text=infos[sha1].subject,
                         )
                 yield '\n'
+                if announced:
+                    for line in self.expand_lines(ANNOUNCED_REVISIONS_TEMPLATE):
+                        yield line
+                    yield '\n'
                 for line in self.generate_new_revision_summary(
-                        tot, [r.rev.sha1 for r in new_revisions], push):
+                        len(sha1s) - len(announced), sha1s, push):
                     yield line
             else:
                 for line in self.expand_lines(NO_NEW_REVISIONS_TEMPLATE):
@@ -1481,66 +2818,79 @@ class ReferenceChange(Change):
             # that reference* by this reference change, along with a
             # diff between the trees for its old and new values.
 
-            # List of the revisions that were added to the branch by
-            # this update.  Note this list can include revisions that
-            # have already had notification emails; we want such
-            # revisions in the summary even though we will not send
-            # new notification emails for them.
-            adds = list(generate_summaries(
-                '--topo-order', '--reverse', '%s..%s'
-                % (self.old.commit_sha1, self.new.commit_sha1,)
-                ))
-
-            # List of the revisions that were removed from the branch
-            # by this update.  This will be empty except for
-            # non-fast-forward updates.
-            discards = list(generate_summaries(
-                '%s..%s' % (self.new.commit_sha1, self.old.commit_sha1,)
-                ))
+            # The revisions that were removed from the branch by this
+            # update (this will be empty except for non-fast-forward
+            # updates), and the revisions that were added to the
+            # branch by this update.  Note the latter can include
+            # revisions that have already had notification emails; we
+            # want such revisions in the summary even though we will
+            # not send new notification emails for them.
+            (discards, adds) = push.get_left_right_summaries(self)
+            adds = list(reversed(adds))
+
+            # The new revisions making the same changes as discarded
+            # ones are not described again (see
+            # Push.get_rebased_commits()):
+            rebased_commits = push.get_rebased_commits(self)
 
             if adds:
-                new_commits_list = push.get_new_commits(self)
+                new_commits_list = [
+                    sha1 for sha1 in push.get_new_commits(self)
+                    if sha1 not in rebased_commits
+                    ]
             else:
                 new_commits_list = []
-            new_commits = CommitSet(new_commits_list)
+            new_commits = set(new_commits_list)
+            # The new revisions already announced to the recipients of
+            # their emails are not described again (see
+            # AnnouncementRegistry):
+            announced = push.get_announced_commits(self, new_commits_list)
 
             if discards:
-                discarded_commits = CommitSet(push.get_discarded_commits(self))
+                discarded_commits = set(push.get_discarded_commits(self))
             else:
-                discarded_commits = CommitSet([])
+                discarded_commits = set()
 
             if discards and adds:
-                for (sha1, subject) in discards:
+                for (sha1, sha1_short, subject) in discards:
                     if sha1 in discarded_commits:
                         action = 'discard'
                     else:
                         action = 'omit'
                     yield self.expand(
                         BRIEF_SUMMARY_TEMPLATE, action=action,
-                        rev_short=sha1, text=subject,
+                        rev_short=sha1_short, text=subject,
                         )
-                for (sha1, subject) in adds:
-                    if sha1 in new_commits:
+                for (sha1, sha1_short, subject) in adds:
+                    if sha1 in rebased_commits:
+                        action = 'rebased'
+                    elif sha1 in announced:
+                        action = 'notified'
+                    elif sha1 in new_commits:
                         action = 'new'
                     else:
                         action = 'add'
                     yield self.expand(
                         BRIEF_SUMMARY_TEMPLATE, action=action,
-                        rev_short=sha1, text=subject,
+                        rev_short=sha1_short, text=subject,
                         )
                 yield '\n'
                 for line in self.expand_lines(NON_FF_TEMPLATE):
                     yield line
+                if rebased_commits:
+                    yield '\n'
+                    for line in self.expand_lines(REBASED_REVISIONS_TEMPLATE):
+                        yield line
 
             elif discards:
-                for (sha1, subject) in discards:
+                for (sha1, sha1_short, subject) in discards:
                     if sha1 in discarded_commits:
                         action = 'discard'
                     else:
                         action = 'omit'
                     yield self.expand(
                         BRIEF_SUMMARY_TEMPLATE, action=action,
-                        rev_short=sha1, text=subject,
+                        rev_short=sha1_short, text=subject,
                         )
                 yield '\n'
                 for line in self.expand_lines(REWIND_ONLY_TEMPLATE):
@@ -1552,21 +2902,27 @@ class ReferenceChange(Change):
                     BRIEF_SUMMARY_TEMPLATE, action='from',
                     rev_short=sha1, text=subject,
                     )
-                for (sha1, subject) in adds:
-                    if sha1 in new_commits:
+                for (sha1, sha1_short, subject) in adds:
+                    if sha1 in announced:
+                        action = 'notified'
+                    elif sha1 in new_commits:
                         action = 'new'
                     else:
                         action = 'add'
                     yield self.expand(
                         BRIEF_SUMMARY_TEMPLATE, action=action,
-                        rev_short=sha1, text=subject,
+                        rev_short=sha1_short, text=subject,
                         )
 
             yield '\n'
 
+            if announced:
+                for line in self.expand_lines(ANNOUNCED_REVISIONS_TEMPLATE):
+                    yield line
+                yield '\n'
             if new_commits:
                 for line in self.generate_new_revision_summary(
-                        len(new_commits), new_commits_list, push):
+                        len(new_commits) - len(announced), new_commits_list, push):
                     yield line
             else:
                 for line in self.expand_lines(NO_NEW_REVISIONS_TEMPLATE):
@@ -1583,11 +2939,12 @@ class ReferenceChange(Change):
             # previous revisions in the case of non-fast-forward updates.
             yield '\n'
             yield 'Summary of changes:\n'
-            for line in read_git_lines(
+            for line in iter_git_lines(
                     ['diff-tree'] +
                     self.diffopts +
                     ['%s..%s' % (self.old.commit_sha1, self.new.commit_sha1,)],
                     keepends=True,
+                    max_line_length=self.environment.get_email_max_line_length(),
                     ):
                 yield line
 
@@ -1596,20 +2953,16 @@ class ReferenceChange(Change):
             # removed from the repository by this reference change.
 
             sha1s = list(push.get_discarded_commits(self))
-            tot = len(sha1s)
-            discarded_revisions = [
-                Revision(self, GitObject(sha1), num=i + 1, tot=tot)
-                for (i, sha1) in enumerate(sha1s)
-                ]
 
-            if discarded_revisions:
+            if sha1s:
+                infos = push.get_commit_infos(sha1s)
                 for line in self.expand_lines(DISCARDED_REVISIONS_TEMPLATE):
                     yield line
                 yield '\n'
-                for r in discarded_revisions:
-                    (sha1, subject) = r.rev.get_summary()
-                    yield r.expand(
-                        BRIEF_SUMMARY_TEMPLATE, action='discard', text=subject,
+                for sha1 in sha1s:
+                    yield self.expand(
+                        BRIEF_SUMMARY_TEMPLATE, action='discard',
+                        rev_short=infos[sha1].sha1_short, text=infos[sha1].subject,
                         )
                 for line in self.generate_revision_change_graph(push):
                     yield line
@@ -1663,7 +3016,7 @@ class BranchChange(ReferenceChange):
         self.recipients = environment.get_refchange_recipients(self)
         self._single_revision = None
 
-    def send_single_combined_email(self, known_added_sha1s):
+    def send_single_combined_email(self, known_added_sha1s, push=None):
         if not self.environment.combine_when_single_commit:
             return None
 
@@ -1739,7 +3092,11 @@ class BranchChange(ReferenceChange):
 
             # We do not want to combine revision and refchange emails if
             # those go to separate locations.
-            rev = Revision(self, GitObject(new_commits[0][0]), 1, tot)
+            sha1 = new_commits[0][0]
+            info = None
+            if push is not None:
+                info = push.get_commit_infos([sha1])[sha1]
+            rev = Revision(self, GitObject(sha1, type='commit'), 1, tot, info=info)
             if rev.recipients != self.recipients:
                 return None
 
@@ -1803,10 +3160,10 @@ class BranchChange(ReferenceChange):
             ))
 
         yield self.expand("The following commit(s) were added to %(refname)s by this push:\n")
-        for (sha1, subject) in adds:
+        for (sha1, sha1_short, subject) in adds:
             yield self.expand(
                 BRIEF_SUMMARY_TEMPLATE, action='new',
-                rev_short=sha1, text=subject,
+                rev_short=sha1_short, text=subject,
                 )
 
         yield self._single_revision.rev.short + " is described below\n"
@@ -1860,7 +3217,12 @@ class AnnotatedTagChange(ReferenceChange):
                 yield ' replaces %s\n' % (prevtag,)
         else:
             prevtag = None
-            yield '  length %s bytes\n' % (read_git_output(['cat-file', '-s', tagobject]),)
+            info = read_object_info(tagobject)
+            if info:
+                size = info[2]
+            else:
+                size = read_git_output(['cat-file', '-s', tagobject])
+            yield '  length %s bytes\n' % (size,)
 
         yield '      by %s\n' % (tagger,)
         yield '      on %s\n' % (tagged,)
@@ -1869,7 +3231,11 @@ class AnnotatedTagChange(ReferenceChange):
         # Show the content of the tag message; this might contain a
         # change log or release notes so is worth displaying.
         yield LOGBEGIN
-        contents = list(read_git_lines(['cat-file', 'tag', self.new.sha1], keepends=True))
+        obj = read_object_contents(self.new.sha1)
+        if obj and obj[1] == 'tag':
+            contents = obj[2].splitlines(True)
+        else:
+            contents = list(read_git_lines(['cat-file', 'tag', self.new.sha1], keepends=True))
         contents = contents[contents.index('\n') + 1:]
         if contents and contents[-1][-1:] != '\n':
             contents.append('\n')
@@ -2036,7 +3402,27 @@ class SendMailer(Mailer):
         if envelopesender:
             self.command.extend(['-f', envelopesender])
 
+    def _log_generation_error(self):
+        self.environment.get_logger().error(
+            '*** Error while generating commit email\n'
+            '***  - mail sending aborted.\n'
+            )
+
     def send(self, lines, to_addrs):
+        # The header of the email is generated before running the
+        # command, so that the command is not run at all for an email
+        # whose header cannot be generated (e.g., because of an invalid
+        # multimailhook.emailPrefix):
+        lines = iter(lines)
+        header = []
+        try:
+            for line in lines:
+                header.append(line)
+                if line == '\n':
+                    break
+        except Exception:
+            self._log_generation_error()
+            raise
         try:
             p = subprocess.Popen(self.command, stdin=subprocess.PIPE)
         except OSError:
@@ -2048,18 +3434,14 @@ class SendMailer(Mailer):
                 )
             sys.exit(1)
         try:
-            lines = (str_to_bytes(line) for line in lines)
-            p.stdin.writelines(lines)
+            p.stdin.writelines(str_to_bytes(line) for line in header)
+            p.stdin.writelines(str_to_bytes(line) for line in lines)
         except Exception:
-            self.environment.get_logger().error(
-                '*** Error while generating commit email\n'
-                '***  - mail sending aborted.\n'
-                )
+            self._log_generation_error()
             if hasattr(p, 'terminate'):
                 # subprocess.terminate() is not available in Python 2.4
                 p.terminate()
             else:
-                import signal
                 os.kill(p.pid, signal.SIGTERM)
             raise
         else:
@@ -2069,8 +3451,53 @@ class SendMailer(Mailer):
                 raise CommandError(self.command, retcode)
 
 
+# Line endings that must be sent as CRLF over SMTP:
+SMTP_EOL_RE = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+
+
+def generate_smtp_data(lines, chunk_size=65536):
+    """Encode lines as the contents of an SMTP DATA command.
+
+    Iterate over chunks of bytes of about chunk_size bytes, with line
+    endings converted to CRLF and lines starting with '.' escaped, as
+    done by smtplib for a complete message.  The terminating '.' line
+    is not included."""
+
+    chunk = []
+    size = 0
+    at_line_start = True
+    for line in lines:
+        line = SMTP_EOL_RE.sub('\r\n', line)
+        if at_line_start and line.startswith('.'):
+            line = '.' + line
+        line = line.replace('\r\n.', '\r\n..')
+        if line:
+            at_line_start = line.endswith('\r\n')
+        data = str_to_bytes(line)
+        chunk.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if not at_line_start:
+        chunk.append(b'\r\n')
+    if chunk:
+        yield b''.join(chunk)
+
+
 class SMTPMailer(Mailer):
-    """Send emails using Python's smtplib."""
+    """Send emails using Python's smtplib.
+
+    The message is not built in memory: its lines are written to the
+    connection as they are generated (see generate_smtp_data()).
+
+    If connections is set to a dict (as done by the daemon, see
+    serve_daemon_worker()), close() keeps the connection open in it,
+    and the next SMTPMailer with the same settings reuses it if the
+    server still answers."""
+
+    connections = None
 
     def __init__(self, environment,
                  envelopesender, smtpserver,
@@ -2100,6 +3527,36 @@ class SMTPMailer(Mailer):
         self.password = smtppass
         self.smtpcacerts = smtpcacerts
         self.loggedin = False
+        self.connection_key = (
+            smtpserver, smtpservertimeout, smtpserverdebuglevel,
+            smtpencryption, smtpuser, smtppass, smtpcacerts,
+            )
+        if not self._reuse_connection():
+            self._connect()
+
+    def _reuse_connection(self):
+        """Take over a connection kept open by a previous close()."""
+
+        if self.connections is None:
+            return False
+        entry = self.connections.pop(self.connection_key, None)
+        if entry is None:
+            return False
+        (smtp, loggedin) = entry
+        try:
+            if smtp.noop()[0] == 250:
+                self.smtp = smtp
+                self.loggedin = loggedin
+                return True
+        except (smtplib.SMTPException, socket.error):
+            pass
+        try:
+            smtp.close()
+        except socket.error:
+            pass
+        return False
+
+    def _connect(self):
         try:
             def call(klass, server, timeout):
                 try:
@@ -2178,23 +3635,74 @@ class SMTPMailer(Mailer):
 
     def close(self):
         if hasattr(self, 'smtp'):
-            self.smtp.quit()
+            smtp = self.smtp
             del self.smtp
+            if self.connections is None:
+                smtp.quit()
+                return
+            previous = self.connections.get(self.connection_key)
+            self.connections[self.connection_key] = (smtp, self.loggedin)
+            if previous is not None:
+                previous[0].quit()
 
     def __del__(self):
         self.close()
 
+    def _sendmail(self, to_addrs, lines):
+        """Like smtplib.SMTP.sendmail(), but stream the message lines."""
+
+        smtp = self.smtp
+        smtp.ehlo_or_helo_if_needed()
+        (code, resp) = smtp.mail(self.envelopesender)
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, self.envelopesender)
+        refused = {}
+        for addr in to_addrs:
+            (code, resp) = smtp.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        smtp.putcmd('data')
+        (code, resp) = smtp.getreply()
+        if code != 354:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        try:
+            for chunk in generate_smtp_data(lines):
+                smtp.send(chunk)
+        except (smtplib.SMTPException, socket.error):
+            raise
+        except Exception:
+            # The message is incomplete; drop the connection rather
+            # than terminating the DATA command, so that the server
+            # discards it.
+            self.environment.get_logger().error(
+                '*** Error while generating commit email\n'
+                '***  - mail sending aborted.\n'
+                )
+            del self.smtp
+            smtp.close()
+            raise
+        smtp.send(b'.\r\n')
+        (code, resp) = smtp.getreply()
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
     def send(self, lines, to_addrs):
         try:
             if self.username or self.password:
                 if not self.loggedin:
                     self.smtp.login(self.username, self.password)
                     self.loggedin = True
-            msg = ''.join(lines)
             # turn comma-separated list into Python list if needed.
             if is_string(to_addrs):
                 to_addrs = [email for (name, email) in getaddresses([to_addrs])]
-            self.smtp.sendmail(self.envelopesender, to_addrs, msg.encode('utf8'))
+            self._sendmail(to_addrs, lines)
         except socket.timeout:
             self.environment.get_logger().error(
                 '*** Error sending email ***\n'
@@ -2220,35 +3728,249 @@ class SMTPMailer(Mailer):
             sys.exit(1)
 
 
-class OutputMailer(Mailer):
-    """Write emails to an output stream, bracketed by lines of '=' characters.
-
-    This is intended for debugging purposes."""
+class RenderBuffer(object):
+    """The lines of an email rendered by another thread.
 
-    SEPARATOR = '=' * 75 + '\n'
+    The rendering thread adds the lines with put() as they are
+    generated, and calls finish() when the email is complete (or could
+    not be generated).  Iterating over the buffer yields the lines as
+    they arrive.  At most MAX_LINES lines are held: put() waits until
+    the consumer has caught up, or raises Cancelled once cancel() has
+    been called."""
 
-    def __init__(self, f, environment=None):
-        super(OutputMailer, self).__init__(environment=environment)
-        self.f = f
+    MAX_LINES = 1000
 
-    def send(self, lines, to_addrs):
-        write_str(self.f, self.SEPARATOR)
-        for line in lines:
-            write_str(self.f, line)
-        write_str(self.f, self.SEPARATOR)
+    class Cancelled(Exception):
+        pass
 
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._lines = []
+        self._done = False
+        self._error = None
+        self._cancelled = False
+
+    def put(self, line):
+        with self._condition:
+            while len(self._lines) >= self.MAX_LINES and not self._cancelled:
+                self._condition.wait()
+            if self._cancelled:
+                raise self.Cancelled()
+            self._lines.append(line)
+            self._condition.notify_all()
+
+    def finish(self, error=None):
+        with self._condition:
+            self._done = True
+            self._error = error
+            self._condition.notify_all()
+
+    def cancel(self):
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+
+    def __iter__(self):
+        while True:
+            with self._condition:
+                while not self._lines and not self._done:
+                    self._condition.wait()
+                (lines, self._lines) = (self._lines, [])
+                self._condition.notify_all()
+                if not lines:
+                    if self._error is not None:
+                        raise self._error
+                    return
+            for line in lines:
+                yield line
 
-def get_git_dir():
-    """Determine GIT_DIR.
 
-    Determine GIT_DIR either from the GIT_DIR environment variable or
-    from the working directory, using Git's usual rules."""
+class QueuedMailer(Mailer):
+    """Send emails through another Mailer from a background thread.
+
+    send() renders the email in the calling thread, then puts it in a
+    bounded queue and returns, so that the next email can be
+    generated while this one is being delivered by the wrapped
+    mailer.  Emails are delivered in the order they were queued.  If
+    delivering an email fails, the remaining emails are dropped and
+    the error is raised by the next call to send() or by close()."""
+
+    # The maximum number of rendered emails waiting to be delivered:
+    QUEUE_SIZE = 4
+
+    def __init__(self, mailer, environment=None):
+        super(QueuedMailer, self).__init__(environment or mailer.environment)
+        self.mailer = mailer
+        self._queue = queue.Queue(self.QUEUE_SIZE)
+        self._error = None
+        # Started by the first send(), so that the mailer can be
+        # created before detach() forks:
+        self._thread = None
+
+    def _deliver(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                (lines, to_addrs) = item
+                try:
+                    self.mailer.send(lines, to_addrs)
+                except:
+                    # This includes SystemExit, which the other
+                    # mailers use to report delivery errors.
+                    self._error = sys.exc_info()[1]
 
-    try:
-        return read_git_output(['rev-parse', '--git-dir'])
-    except CommandError:
-        sys.stderr.write('fatal: git_multimail: not in a git directory\n')
-        sys.exit(1)
+    def _raise_error(self):
+        if self._error is not None:
+            (error, self._error) = (self._error, None)
+            raise error
+
+    def send(self, lines, to_addrs):
+        self._raise_error()
+        try:
+            lines = list(lines)
+        except Exception:
+            self.environment.get_logger().error(
+                '*** Error while generating commit email\n'
+                '***  - mail sending aborted.\n'
+                )
+            raise
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._deliver)
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put((lines, to_addrs))
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self.mailer is not None:
+            self.mailer.close()
+            self.mailer = None
+        self._raise_error()
+
+
+SPOOL_SUBDIRS = ['tmp', 'new', 'cur', 'failed']
+
+
+class SpoolMailer(Mailer):
+    """Write emails to a Maildir-like spool directory, for later delivery.
+
+    Each email is written to a file in the 'tmp' subdirectory of the
+    spool, then atomically moved to its 'new' subdirectory once
+    complete.  The file starts with the envelope recipients, one per
+    line, separated from the email by an empty line.  Spooled emails
+    are sent by 'git_multimail.py --deliver-spool', see
+    deliver_spool()."""
+
+    ENVELOPE_TO = 'X-Envelope-To: '
+
+    def __init__(self, environment, spooldir):
+        super(SpoolMailer, self).__init__(environment)
+        self.spooldir = spooldir
+        for subdir in SPOOL_SUBDIRS:
+            path = os.path.join(spooldir, subdir)
+            try:
+                os.makedirs(path)
+            except OSError:
+                # It may have been created by a concurrent process.
+                if not os.path.isdir(path):
+                    raise
+        self.hostname = socket.gethostname().replace('/', '_').replace(':', '_')
+        self.count = 0
+
+    def _new_name(self):
+        """Return a unique file name, sorting in chronological order."""
+
+        self.count += 1
+        return '%016d.P%dQ%06d.%s' % (
+            time.time() * 1000000, os.getpid(), self.count, self.hostname,
+            )
+
+    def send(self, lines, to_addrs):
+        # turn comma-separated list into Python list if needed.
+        if is_string(to_addrs):
+            to_addrs = [email for (name, email) in getaddresses([to_addrs])]
+        name = self._new_name()
+        tmp_path = os.path.join(self.spooldir, 'tmp', name)
+        f = open(tmp_path, 'wb')
+        try:
+            try:
+                for addr in to_addrs:
+                    f.write(str_to_bytes(self.ENVELOPE_TO + addr + '\n'))
+                f.write(b'\n')
+                for line in lines:
+                    f.write(str_to_bytes(line))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+        except Exception:
+            self.environment.get_logger().error(
+                '*** Error while generating commit email\n'
+                '***  - mail spooling aborted.\n'
+                )
+            os.unlink(tmp_path)
+            raise
+        os.rename(tmp_path, os.path.join(self.spooldir, 'new', name))
+
+
+class DeferredMailer(Mailer):
+    """Create another Mailer only when the first email is sent.
+
+    This is used when the hook detaches, so that the connection to the
+    SMTP server is only opened by the background process, once it may
+    send emails, and cannot time out while it waits for the emails of
+    previous pushes."""
+
+    def __init__(self, make_mailer, environment=None):
+        super(DeferredMailer, self).__init__(environment)
+        self.make_mailer = make_mailer
+        self.mailer = None
+
+    def send(self, lines, to_addrs):
+        if self.mailer is None:
+            self.mailer = self.make_mailer()
+        self.mailer.send(lines, to_addrs)
+
+    def close(self):
+        if self.mailer is not None:
+            self.mailer.close()
+            self.mailer = None
+
+
+class OutputMailer(Mailer):
+    """Write emails to an output stream, bracketed by lines of '=' characters.
+
+    This is intended for debugging purposes."""
+
+    SEPARATOR = '=' * 75 + '\n'
+
+    def __init__(self, f, environment=None):
+        super(OutputMailer, self).__init__(environment=environment)
+        self.f = f
+
+    def send(self, lines, to_addrs):
+        write_str(self.f, self.SEPARATOR)
+        for line in lines:
+            write_str(self.f, line)
+        write_str(self.f, self.SEPARATOR)
+
+
+def get_git_dir():
+    """Determine GIT_DIR.
+
+    Determine GIT_DIR either from the GIT_DIR environment variable or
+    from the working directory, using Git's usual rules."""
+
+    try:
+        return read_git_output(['rev-parse', '--git-dir'])
+    except CommandError:
+        sys.stderr.write('fatal: git_multimail: not in a git directory\n')
+        sys.exit(1)
 
 
 class Environment(object):
@@ -2406,6 +4128,67 @@ class Environment(object):
         stdout (bool)
             Write email to stdout rather than emailing. Useful for debugging
 
+        max_commit_emails_action (string)
+
+            What to do when a change has more than maxcommitemails
+            new commits: "stop" sending commit emails, or send a
+            "digest" of them (see CommitDigest).
+
+        render_jobs (int)
+
+            The number of commit emails that are rendered concurrently
+            (by a pool of threads).  1 (the default) renders them one
+            after the other.
+
+        detach (bool)
+
+            True if the post-receive hook should generate and send
+            emails in a background process, so that "git push" does
+            not wait for them.  See detach().
+
+        use_bitmap_index (bool)
+
+            True if "git rev-list" should use the reachability bitmap
+            index of the repository for the queries that can use it.
+
+        write_commit_graph (bool)
+
+            True if the post-receive hook should write the
+            commit-graph of the repository when it is missing or
+            stale.  See update_commit_graph().
+
+        cache_file (string)
+
+            The SQLite database in which commit metadata is kept
+            between invocations, or None.  See CommitInfoCache.
+
+        cache_size (int)
+
+            The maximum number of commits kept in cache_file.
+
+        detect_rebases (bool)
+
+            True if the new commits making the same changes as commits
+            removed by a non-fast-forward update should only be listed
+            in the reference change email.  See
+            Push.get_rebased_commits().
+
+        announced_commits_file (string)
+
+            The SQLite database recording the commits already
+            announced to each list of recipients, or None.  See
+            AnnouncementRegistry.
+
+        announced_commits_max_age (int)
+
+            The number of days after which the announcements recorded
+            in announced_commits_file are forgotten.
+
+        ref_snapshot_file (string)
+
+            The file in which the post-receive hook keeps a snapshot
+            of the references, or None.  See RefSnapshot.
+
         combine_when_single_commit (bool)
 
             True if a combined email should be produced when a single
@@ -2439,6 +4222,17 @@ class Environment(object):
         self.html_in_footer = False
         self.commitBrowseURL = None
         self.maxcommitemails = 500
+        self.max_commit_emails_action = 'stop'
+        self.render_jobs = 1
+        self.detach = False
+        self.ref_snapshot_file = None
+        self.cache_file = None
+        self.cache_size = 100000
+        self.announced_commits_file = None
+        self.announced_commits_max_age = 90
+        self.detect_rebases = False
+        self.use_bitmap_index = False
+        self.write_commit_graph = False
         self.excludemergerevisions = False
         self.diffopts = ['--stat', '--summary', '--find-copies-harder']
         self.graphopts = ['--oneline', '--decorate']
@@ -2541,6 +4335,16 @@ class Environment(object):
 
         raise NotImplementedError()
 
+    def get_digest_recipients(self, digest):
+        """Return the recipients for digest.
+
+        Return the list of email addresses to which the specified
+        CommitDigest, which is sent instead of the emails about the
+        new commits of a ReferenceChange, should be sent.  By default,
+        it is sent to the recipients of the reference change email."""
+
+        return self.get_refchange_recipients(digest.reference_change)
+
     def get_announce_recipients(self, annotated_tag_change):
         """Return the recipients for notifications about annotated_tag_change.
 
@@ -2583,6 +4387,15 @@ class Environment(object):
         Longer subject lines will be truncated."""
         raise NotImplementedError()
 
+    def get_email_max_line_length(self):
+        """Return the maximal length of the lines of email bodies, or None.
+
+        Longer lines are truncated by filter_body(); the output of git
+        is cut at a greater length while it is read (see
+        iter_output()), so that they are never held in memory whole."""
+
+        return None
+
     def filter_body(self, lines):
         """Filter the lines intended for an email body.
 
@@ -2679,18 +4492,69 @@ class ConfigOptionsEnvironmentMixin(ConfigEnvironmentMixin):
 
         self.commitBrowseURL = config.get('commitBrowseURL')
 
-        self.excludemergerevisions = config.get('excludeMergeRevisions')
+        self.excludemergerevisions = config.get_bool('excludeMergeRevisions', default=False)
 
-        maxcommitemails = config.get('maxcommitemails')
-        if maxcommitemails is not None:
-            try:
-                self.maxcommitemails = int(maxcommitemails)
-            except ValueError:
+        try:
+            maxcommitemails = config.get_int('maxcommitemails')
+            if maxcommitemails is not None:
+                self.maxcommitemails = maxcommitemails
+        except ValueError:
+            self.log_warning(
+                '*** Malformed value for multimailhook.maxCommitEmails: %s\n'
+                % config.get('maxcommitemails') +
+                '*** Expected a number.  Ignoring.\n'
+                )
+
+        max_commit_emails_action = config.get('maxCommitEmailsAction')
+        if max_commit_emails_action is not None:
+            if max_commit_emails_action not in ['stop', 'digest']:
                 self.log_warning(
-                    '*** Malformed value for multimailhook.maxCommitEmails: %s\n'
-                    % maxcommitemails +
-                    '*** Expected a number.  Ignoring.\n'
+                    '*** Unknown value for multimailhook.maxCommitEmailsAction: %s\n'
+                    % max_commit_emails_action +
+                    '*** Expected either "stop" or "digest".  Ignoring.\n'
                     )
+            else:
+                self.max_commit_emails_action = max_commit_emails_action
+
+        try:
+            render_jobs = config.get_int('renderJobs')
+            if render_jobs is not None:
+                self.render_jobs = max(render_jobs, 1)
+        except ValueError:
+            self.log_warning(
+                '*** Malformed value for multimailhook.renderJobs: %s\n'
+                % config.get('renderJobs') +
+                '*** Expected a number.  Ignoring.\n'
+                )
+
+        self.detach = config.get_bool('detach', default=False)
+        self.ref_snapshot_file = config.get('refSnapshotFile')
+        self.cache_file = config.get('cacheFile')
+        self.announced_commits_file = config.get('announcedCommitsFile')
+        self.detect_rebases = config.get_bool('detectRebases', default=False)
+
+        try:
+            cache_size = config.get_int('cacheSize')
+            if cache_size is not None:
+                self.cache_size = cache_size
+        except ValueError:
+            self.log_warning(
+                '*** Malformed value for multimailhook.cacheSize: %s\n'
+                % config.get('cacheSize') +
+                '*** Expected a number.  Ignoring.\n'
+                )
+        try:
+            max_age = config.get_int('announcedCommitsMaxAge')
+            if max_age is not None:
+                self.announced_commits_max_age = max_age
+        except ValueError:
+            self.log_warning(
+                '*** Malformed value for multimailhook.announcedCommitsMaxAge: %s\n'
+                % config.get('announcedCommitsMaxAge') +
+                '*** Expected a number.  Ignoring.\n'
+                )
+        self.use_bitmap_index = config.get_bool('useBitmapIndex', default=False)
+        self.write_commit_graph = config.get_bool('writeCommitGraph', default=False)
 
         diffopts = config.get('diffopts')
         if diffopts is not None:
@@ -2865,6 +4729,11 @@ class FilterLinesEnvironmentMixin(Environment):
     def get_max_subject_length(self):
         return self.__max_subject_length
 
+    def get_email_max_line_length(self):
+        if self.__email_max_line_length and self.__email_max_line_length > 0:
+            return self.__email_max_line_length
+        return super(FilterLinesEnvironmentMixin, self).get_email_max_line_length()
+
 
 class ConfigFilterLinesEnvironmentMixin(
         ConfigEnvironmentMixin,
@@ -2877,13 +4746,13 @@ class ConfigFilterLinesEnvironmentMixin(
         if strict_utf8 is not None:
             kw['strict_utf8'] = strict_utf8
 
-        email_max_line_length = config.get('emailmaxlinelength')
+        email_max_line_length = config.get_int('emailmaxlinelength')
         if email_max_line_length is not None:
-            kw['email_max_line_length'] = int(email_max_line_length)
+            kw['email_max_line_length'] = email_max_line_length
 
-        max_subject_length = config.get('subjectMaxLength', default=email_max_line_length)
+        max_subject_length = config.get_int('subjectMaxLength', default=email_max_line_length)
         if max_subject_length is not None:
-            kw['max_subject_length'] = int(max_subject_length)
+            kw['max_subject_length'] = max_subject_length
 
         super(ConfigFilterLinesEnvironmentMixin, self).__init__(
             config=config, **kw
@@ -2911,7 +4780,7 @@ class ConfigMaxlinesEnvironmentMixin(
     """Limit the email body to the number of lines specified in config."""
 
     def __init__(self, config, **kw):
-        emailmaxlines = int(config.get('emailmaxlines', default='0'))
+        emailmaxlines = config.get_int('emailmaxlines', default=0)
         super(ConfigMaxlinesEnvironmentMixin, self).__init__(
             config=config,
             emailmaxlines=emailmaxlines,
@@ -2950,6 +4819,25 @@ class ConfigFQDNEnvironmentMixin(
             )
 
 
+# The FQDN computed by compute_fqdn(), which can be slow to look up:
+FQDN = None
+
+
+def compute_fqdn():
+    global FQDN
+
+    if FQDN is None:
+        fqdn = socket.getfqdn()
+        # Sometimes, socket.getfqdn() returns localhost or
+        # localhost.localhost, which isn't very helpful. In this case,
+        # fall-back to socket.gethostname() which may return an actual
+        # hostname.
+        if fqdn == 'localhost' or fqdn == 'localhost.localdomain':
+            fqdn = socket.gethostname()
+        FQDN = fqdn
+    return FQDN
+
+
 class ComputeFQDNEnvironmentMixin(FQDNEnvironmentMixin):
     """Get the FQDN by calling socket.getfqdn()."""
 
@@ -2960,14 +4848,7 @@ class ComputeFQDNEnvironmentMixin(FQDNEnvironmentMixin):
             )
 
     def get_fqdn(self):
-        fqdn = socket.getfqdn()
-        # Sometimes, socket.getfqdn() returns localhost or
-        # localhost.localhost, which isn't very helpful. In this case,
-        # fall-back to socket.gethostname() which may return an actual
-        # hostname.
-        if fqdn == 'localhost' or fqdn == 'localhost.localdomain':
-            fqdn = socket.gethostname()
-        return fqdn
+        return compute_fqdn()
 
 
 class PusherDomainEnvironmentMixin(ConfigEnvironmentMixin):
@@ -3032,6 +4913,12 @@ class StaticRecipientsEnvironmentMixin(Environment):
                          self).get_refchange_recipients(revision)
         return self.__revision_recipients
 
+    def get_digest_recipients(self, digest):
+        if self.__revision_recipients is None:
+            return super(StaticRecipientsEnvironmentMixin,
+                         self).get_digest_recipients(digest)
+        return self.__revision_recipients
+
 
 class CLIRecipientsEnvironmentMixin(Environment):
     """Mixin storing recipients information coming from the
@@ -3059,6 +4946,12 @@ class CLIRecipientsEnvironmentMixin(Environment):
                          self).get_revision_recipients(revision)
         return self.__cli_recipients
 
+    def get_digest_recipients(self, digest):
+        if self.__cli_recipients is None:
+            return super(CLIRecipientsEnvironmentMixin,
+                         self).get_digest_recipients(digest)
+        return self.__cli_recipients
+
 
 class ConfigRecipientsEnvironmentMixin(
         ConfigEnvironmentMixin,
@@ -3403,9 +5296,7 @@ class GerritEnvironmentHighPrecMixin(Environment):
         # in the Web UI (or do equivalently with REST APIs or the gerrit review
         # command) are not something users want to see an individual email for.
         # Filter them out.
-        committer = read_git_output(['log', '--no-walk', '--format=%cN',
-                                     revision.rev.sha1])
-        if committer == 'Gerrit Code Review':
+        if revision.committer == 'Gerrit Code Review':
             return []
         else:
             return super(GerritEnvironmentHighPrecMixin, self).get_revision_recipients(revision)
@@ -3457,6 +5348,160 @@ class GiteaEnvironmentLowPrecMixin(Environment):
         return self.osenv.get('GITEA_PUSHER_EMAIL')
 
 
+class CommitLogReader(object):
+    """Read the "git log" output describing many commits at once.
+
+    Running "git log -1" for each commit email costs one git process
+    per commit.  Instead, run a single "git log --no-walk=unsorted
+    --stdin" over all of the commits that will be described, in the
+    order in which their emails will be generated, and split its
+    output into one part per commit as it is read.
+
+    The output of each commit starts with a "commit <sha1>" line, and
+    the outputs of consecutive commits are separated by an empty line.
+    As the sha1 of the next commit is known, this is unambiguous
+    (message lines are indented and diff lines have a prefix) as long
+    as the log options don't change the layout of the output; if they
+    do, or for commits that are not part of the stream, a separate
+    "git log -1" is run instead.  If git nevertheless skips a commit
+    (i.e., the header of another commit follows the separator), the
+    stream is abandoned and "git log -1" is used from there on.
+
+    If the caller stops reading the output of a commit early (e.g.,
+    because multimailhook.emailMaxLines has been reached), the git
+    process is terminated and a new one is started for the remaining
+    commits when needed.  Lines longer than max_line_length are cut
+    while they are read (see iter_output())."""
+
+    # Options that change the layout of the output of "git log" or
+    # that can make it skip some of the commits:
+    UNSUPPORTED_OPTIONS_RE = re.compile(
+        r'^(--pretty|--format|--oneline|--graph|--line-prefix|--reverse|--skip'
+        r'|--max-count|-n|-[0-9]|-z$|-L'
+        r'|--(no-)?merges$|--(no-)?(min|max)-parents|--author|--committer'
+        r'|--grep|--invert-grep|--all-match|--since|--after|--until|--before'
+        r'|--max-age|--min-age|--diff-filter|--follow|-S|-G|--pickaxe|--$)'
+        )
+
+    # The header of a commit in the output:
+    HEADER_RE = re.compile(r'^commit [0-9a-f]{40}([ \n]|$)')
+
+    def __init__(self, sha1s, logopts, max_line_length=None):
+        self.logopts = logopts
+        self.max_line_length = max_line_length
+        if [opt for opt in logopts if self.UNSUPPORTED_OPTIONS_RE.match(opt)]:
+            sha1s = []
+        # The commits whose output has not been read yet, in order:
+        self._sha1s = list(sha1s)
+        # The lines output by the running git process, if any:
+        self._lines = None
+        # A line that has been read from self._lines but not consumed:
+        self._pending = None
+
+    def _start(self):
+        self._lines = iter_git_lines(
+            ['log', '--no-walk=unsorted', '--stdin'] + self.logopts,
+            input=''.join(sha1 + '\n' for sha1 in self._sha1s),
+            keepends=True, errors='replace', max_line_length=self.max_line_length,
+            )
+        self._pending = None
+
+    def _stop(self):
+        if self._lines is not None:
+            self._lines.close()
+            self._lines = None
+        self._pending = None
+
+    def _next_line(self):
+        """Return the next line of the output, or None at its end."""
+
+        if self._pending is not None:
+            (line, self._pending) = (self._pending, None)
+            return line
+        try:
+            return next(self._lines)
+        except StopIteration:
+            return None
+
+    def _is_header(self, line, sha1):
+        header = 'commit ' + sha1
+        return line.startswith(header) and line[len(header):len(header) + 1] in ' \n'
+
+    def _read_commit(self):
+        """Iterate over the output of the next commit in the stream."""
+
+        if not self._sha1s:
+            # The stream has been abandoned.
+            raise CommandError(['log', '--no-walk=unsorted', '--stdin'] + self.logopts, None)
+        if self._lines is None:
+            self._start()
+        sha1 = self._sha1s.pop(0)
+        line = self._next_line()
+        if line is None or not self._is_header(line, sha1):
+            # This should not happen; don't trust the stream anymore.
+            self._sha1s = []
+            self._stop()
+            raise CommandError(['log', '--no-walk=unsorted', '--stdin'] + self.logopts, None)
+        yield line
+
+        while True:
+            line = self._next_line()
+            if line is None:
+                break
+            if line == '\n' and self._sha1s:
+                self._pending = self._next_line()
+                if self._pending is not None and self._is_header(self._pending, self._sha1s[0]):
+                    # That empty line was the separator:
+                    break
+                if self._pending is not None and self.HEADER_RE.match(self._pending):
+                    # git skipped the next commit, so the stream cannot
+                    # be split reliably anymore.  The current commit
+                    # is complete; the next ones use "git log -1".
+                    self._sha1s = []
+                    self._stop()
+                    break
+            yield line
+
+    def generate(self, sha1):
+        """Iterate over the "git log" output lines describing commit sha1."""
+
+        if sha1 in self._sha1s:
+            try:
+                # Skip the commits for which no email is generated:
+                while self._sha1s and self._sha1s[0] != sha1:
+                    for line in self._read_commit():
+                        pass
+                lines = self._read_commit()
+                header = next(lines)
+            except CommandError:
+                # Fall back to a separate "git log".
+                pass
+            else:
+                complete = False
+                try:
+                    yield header
+                    for line in lines:
+                        yield line
+                    complete = True
+                finally:
+                    if not complete:
+                        # Stop git; the following commits will be
+                        # read by a new process.
+                        self._stop()
+                return
+
+        for line in iter_git_lines(
+                ['log'] + self.logopts + ['-1', sha1],
+                keepends=True,
+                errors='replace',
+                max_line_length=self.max_line_length):
+            yield line
+
+    def close(self):
+        self._sha1s = []
+        self._stop()
+
+
 class Push(object):
     """Represent an entire push (i.e., a group of ReferenceChanges).
 
@@ -3478,8 +5523,13 @@ class Push(object):
 
     The first step is to determine the "other" references--those
     unaffected by the current push.  They are computed by listing all
-    references then removing any affected by this push.  The results
-    are stored in Push._other_ref_sha1s.
+    references then removing any affected by this push.  When the
+    reference filter allows it, git does this itself, given options
+    like "--not --exclude=refs/heads/master --glob=refs/*" (see
+    _get_other_refs_spec()); otherwise, the results are stored in
+    Push._other_ref_sha1s.  With multimailhook.refSnapshotFile, a few
+    commits from which the other references are known to be reachable
+    can be used instead (see RefSnapshot).
 
     The commits contained in the repository before this push were
 
@@ -3539,15 +5589,43 @@ class Push(object):
             ])
         )
 
-    def __init__(self, environment, changes, ignore_other_refs=False):
+    def __init__(self, environment, changes, ignore_other_refs=False,
+                 other_ref_tips=None):
         self.changes = sorted(changes, key=self._sort_key)
         self.__other_ref_sha1s = None
+        self.__reduced_other_ref_sha1s = None
+        # Commits from which the commits of the other references are
+        # reachable, if known (see RefSnapshot):
+        self.__other_ref_tips = other_ref_tips
         self.__cached_commits_spec = {}
+        self.__walks = {}
+        self.__commit_infos = {}
+        self.__left_right_summaries = {}
+        self.__rebased_commits = {}
+        self.__commit_info_cache = None
+        self.__announcement_registry = None
+        # The (recipients, sha1) claimed in the announcement registry
+        # whose emails have not been sent yet, and those whose emails
+        # were sent but may not be delivered yet:
+        self.__unsent_claims = set()
+        self.__sent_claims = set()
+        # The new commits whose emails are not sent because they could
+        # not be claimed (see get_announced_commits()):
+        self.__announced_commits = set()
+        self.__commit_log_reader = CommitLogReader(
+            [], environment.commitlogopts, environment.get_email_max_line_length(),
+            )
         self.environment = environment
 
         if ignore_other_refs:
             self.__other_ref_sha1s = set()
 
+        # Abbreviate the old and new values of all the references at
+        # once:
+        read_short_sha1s(
+            o for change in self.changes for o in (change.old, change.new)
+            )
+
     @classmethod
     def _sort_key(klass, change):
         return (klass.SORT_ORDER[change.__class__, change.change_type], change.refname,)
@@ -3555,7 +5633,12 @@ class Push(object):
     @property
     def _other_ref_sha1s(self):
         """The GitObjects referred to by references unaffected by this push.
-        """
+
+        If the other references are known to be reachable from a few
+        tips, the tips are returned instead."""
+
+        if self.__other_ref_tips is not None:
+            return self.__other_ref_tips
         if self.__other_ref_sha1s is None:
             # The refnames being changed by this push:
             updated_refs = set(
@@ -3584,6 +5667,44 @@ class Push(object):
 
         return self.__other_ref_sha1s
 
+    def _get_other_refs_spec(self):
+        """Get rev-list arguments excluding the other references.
+
+        If the commits of the references unaffected by this push are
+        known to be reachable from a few tips (see RefSnapshot), return
+        "^sha1" arguments for the tips.  If the reference filter can be
+        expressed as globs, return options making git exclude these
+        references itself, as it is much faster for repositories with
+        many references.  Otherwise (or if _other_ref_sha1s was read
+        already, e.g. for the graphs before detaching), return "^sha1"
+        arguments for _other_ref_sha1s, reduced once to the commits
+        that are not reachable from the others (see reduce_commits())
+        so that each "git rev-list" of the push gets a few exclusions
+        rather than one per reference."""
+
+        if self.__other_ref_sha1s is None and self.__other_ref_tips is None:
+            ref_filter_regex, is_inclusion_filter = \
+                self.environment.get_ref_filter_regex()
+            globs = ref_filter_globs(ref_filter_regex, is_inclusion_filter)
+            if globs is not None:
+                if is_inclusion_filter:
+                    (included, excluded) = (globs, [])
+                else:
+                    (included, excluded) = (['refs/*'], globs)
+                excluded = excluded + sorted(change.refname for change in self.changes)
+                spec = ['--not']
+                for glob in included:
+                    # Exclusions only apply to the next --glob:
+                    spec.extend('--exclude=' + pattern for pattern in excluded)
+                    spec.append('--glob=' + glob)
+                return spec
+
+        if self.__other_ref_tips is not None:
+            return ['^' + sha1 for sha1 in sorted(self.__other_ref_tips)]
+        if self.__reduced_other_ref_sha1s is None:
+            self.__reduced_other_ref_sha1s = reduce_commits(self._other_ref_sha1s)
+        return ['^' + sha1 for sha1 in self.__reduced_other_ref_sha1s]
+
     def _get_commits_spec_incl(self, new_or_old, reference_change=None):
         """Get new or old SHA-1 from one or each of the changed refs.
 
@@ -3637,12 +5758,15 @@ class Push(object):
         excluded are those that are currently in the repository.  """
 
         old_or_new = {'old': 'new', 'new': 'old'}[new_or_old]
-        excl_revs = self._other_ref_sha1s.union(
+        excl_revs = set(
             getattr(change, old_or_new).sha1
             for change in self.changes
             if getattr(change, old_or_new).type in ['commit', 'tag']
             )
-        return ['^' + sha1 for sha1 in sorted(excl_revs)]
+        return (
+            ['^' + sha1 for sha1 in sorted(excl_revs)] +
+            self._get_other_refs_spec()
+            )
 
     def get_commits_spec(self, new_or_old, reference_change=None):
         """Get rev-list arguments for added or discarded commits.
@@ -3673,26 +5797,233 @@ class Push(object):
             self.__cached_commits_spec[key] = ret
         return self.__cached_commits_spec[key]
 
+    def _walk(self, new_or_old):
+        """Return the commits added or discarded by each change.
+
+        Return a triple (sha1s, masks, owned_sha1s), where sha1s is the
+        list of all the commits that, depending on the value of
+        new_or_old, are new to the repository or were discarded from
+        the repository, in topological order (children first), masks
+        is a dict {sha1: bits} whose bit i is set if the commit is
+        reachable from the new or old value of self.changes[i], and
+        owned_sha1s is a dict {ReferenceChange: list} of the commits
+        whose first change (in SORT_ORDER) reaching them is that
+        change, in the same order.
+
+        The commits are listed by a single "git rev-list --topo-order"
+        for all the changes, with the exclusions applied once.  As a
+        commit is only listed after all its children, the changes
+        reaching it are known when it streams by, and are passed on
+        to its parents."""
+
+        if new_or_old not in self.__walks:
+            spec = self.get_commits_spec(new_or_old)
+            if (new_or_old == 'old' and spec is not None and
+                    self.environment.use_bitmap_index):
+                # Most pushes discard no commits.  The bitmap index can
+                # only answer this kind of question, not list commits
+                # in topological order with their parents.
+                count = git_rev_list(spec, args=['--count', '--use-bitmap-index'])
+                self.environment.get_logger().debug(
+                    'Push: %s discarded commits (counted with --use-bitmap-index)' %
+                    (count[0],))
+                if count == ['0']:
+                    spec = None
+            masks = {}
+            for (i, change) in enumerate(self.changes):
+                tip = getattr(change, new_or_old).commit_sha1
+                if tip:
+                    masks[tip] = masks.get(tip, 0) | (1 << i)
+            sha1s = []
+            owned_sha1s = dict((change, []) for change in self.changes)
+            for line in git_rev_list(
+                    spec, args=['--topo-order', '--parents'], stream=True):
+                words = line.split()
+                sha1 = words[0]
+                mask = masks.get(sha1, 0)
+                sha1s.append(sha1)
+                for parent in words[1:]:
+                    masks[parent] = masks.get(parent, 0) | mask
+                if mask:
+                    # The lowest bit set is the first change reaching it:
+                    owned_sha1s[self.changes[(mask & -mask).bit_length() - 1]].append(sha1)
+            self.__walks[new_or_old] = (sha1s, masks, owned_sha1s)
+        return self.__walks[new_or_old]
+
+    def _get_reachable_commits(self, new_or_old, reference_change):
+        """Return the commits of _walk(new_or_old) reachable from reference_change."""
+
+        (sha1s, masks, owned_sha1s) = self._walk(new_or_old)
+        bit = 1 << self.changes.index(reference_change)
+        return [sha1 for sha1 in sha1s if masks.get(sha1, 0) & bit]
+
+    def read_references(self):
+        """Read everything that depends on the references not updated by this push.
+
+        Once git accepts another push, these references could include
+        the commits added by this one, which would then not be
+        considered new anymore.  Call this method before letting the
+        hook exit while emails are still to be generated (e.g., before
+        detaching)."""
+
+        self._walk('new')
+        self._walk('old')
+        if [change for change in self.changes if change.showgraph]:
+            # The graphs are drawn by git from the references.
+            self._other_ref_sha1s
+
     def get_new_commits(self, reference_change=None):
         """Return a list of commits added by this push.
 
         Return a list of the object names of commits that were added
         by the part of this push represented by reference_change.  If
         reference_change is None, then return a list of *all* commits
-        added by this push."""
+        added by this push.  The commits are listed in topological
+        order, children first."""
+
+        if reference_change is None:
+            return list(self._walk('new')[0])
+        return self._get_reachable_commits('new', reference_change)
+
+    def get_handled_commits(self, reference_change):
+        """Return the new commits whose emails go with reference_change.
+
+        Each new commit is handled with the first change (in
+        SORT_ORDER) from which it is reachable.  The commits are listed
+        in topological order, children first."""
 
-        spec = self.get_commits_spec('new', reference_change)
-        return git_rev_list(spec)
+        return list(self._walk('new')[2][reference_change])
 
     def get_discarded_commits(self, reference_change):
         """Return a list of commits discarded by this push.
 
         Return a list of the object names of commits that were
         entirely discarded from the repository by the part of this
-        push represented by reference_change."""
+        push represented by reference_change, in topological order,
+        children first."""
+
+        return self._get_reachable_commits('old', reference_change)
+
+    def get_left_right_summaries(self, reference_change):
+        """Return the summaries of the commits removed and added by reference_change.
+
+        Return (lefts, rights) as returned by read_left_right_summaries()
+        for the old and new values of reference_change, which must
+        both be commits."""
+
+        if reference_change not in self.__left_right_summaries:
+            self.__left_right_summaries[reference_change] = read_left_right_summaries(
+                reference_change.old.commit_sha1, reference_change.new.commit_sha1,
+                )
+        return self.__left_right_summaries[reference_change]
+
+    def get_rebased_commits(self, reference_change):
+        """Return the set of the rebased new commits of reference_change.
+
+        A new commit is rebased if it makes the same changes (has the
+        same "git patch-id --stable") as one of the commits removed
+        from the reference by reference_change.  Such commits are only
+        listed in the reference change email.  The patch ids of all
+        the commits involved are computed by a single pipeline (see
+        read_patch_ids()).  Return an empty set unless
+        multimailhook.detectRebases is set."""
+
+        if not self.environment.detect_rebases:
+            return set()
+        if reference_change not in self.__rebased_commits:
+            rebased = set()
+            if reference_change.old.commit_sha1 and reference_change.new.commit_sha1:
+                (lefts, rights) = self.get_left_right_summaries(reference_change)
+                added = set(sha1 for (sha1, sha1_short, subject) in rights)
+                new = [
+                    sha1 for sha1 in self.get_new_commits(reference_change)
+                    if sha1 in added
+                    ]
+                if lefts and new:
+                    removed = [sha1 for (sha1, sha1_short, subject) in lefts]
+                    patch_ids = read_patch_ids(removed + new)
+                    removed_patch_ids = set(
+                        patch_ids[sha1] for sha1 in removed if sha1 in patch_ids
+                        )
+                    rebased = set(
+                        sha1 for sha1 in new
+                        if patch_ids.get(sha1) in removed_patch_ids
+                        )
+            self.__rebased_commits[reference_change] = rebased
+        return self.__rebased_commits[reference_change]
+
+    def get_commit_infos(self, sha1s):
+        """Return a dict {sha1: CommitInfo} for the commits in sha1s.
+
+        The metadata of all commits that have not been read yet are
+        read with a single git command, and remembered for the rest
+        of the push."""
+
+        missing = [sha1 for sha1 in sha1s if sha1 not in self.__commit_infos]
+        cache = self._get_commit_info_cache()
+        if missing and cache is not None:
+            try:
+                self.__commit_infos.update(read_commit_infos(missing, cache=cache))
+            except sqlite3.Error as e:
+                self.environment.log_warning(
+                    '*** Cannot use multimailhook.cacheFile: %s\n' % (e,))
+                self._close_commit_info_cache()
+        missing = [sha1 for sha1 in missing if sha1 not in self.__commit_infos]
+        self.__commit_infos.update(read_commit_infos(missing))
+        return dict((sha1, self.__commit_infos[sha1]) for sha1 in sha1s)
+
+    def get_commit_numstats(self, sha1s):
+        """Return a dict {sha1: numstat} for the commits in sha1s.
+
+        See read_commit_numstats()."""
+
+        cache = self._get_commit_info_cache()
+        if cache is not None:
+            try:
+                return read_commit_numstats(sha1s, cache=cache)
+            except sqlite3.Error as e:
+                self.environment.log_warning(
+                    '*** Cannot use multimailhook.cacheFile: %s\n' % (e,))
+                self._close_commit_info_cache()
+        return read_commit_numstats(sha1s)
+
+    def _get_commit_info_cache(self):
+        """Return the CommitInfoCache to use, or None.
+
+        The cache is opened the first time it is needed.  If it
+        cannot be used, a warning is logged once and None is
+        returned."""
+
+        if self.__commit_info_cache is None:
+            self.__commit_info_cache = False
+            if not self.environment.cache_file:
+                pass
+            elif sqlite3 is None:
+                self.environment.log_warning(
+                    '*** multimailhook.cacheFile is not supported by this Python.\n')
+            else:
+                try:
+                    self.__commit_info_cache = CommitInfoCache(
+                        self.environment.cache_file, self.environment.cache_size,
+                        get_mailmap_key(),
+                        )
+                except sqlite3.Error as e:
+                    self.environment.log_warning(
+                        '*** Cannot use multimailhook.cacheFile: %s\n' % (e,))
+        return self.__commit_info_cache or None
+
+    def _close_commit_info_cache(self):
+        if self.__commit_info_cache:
+            self.__commit_info_cache.close()
+        self.__commit_info_cache = False
+
+    def generate_commit_log(self, sha1):
+        """Iterate over the "git log" output describing commit sha1.
+
+        The output of the commits sent in commit emails is read by a
+        single git command (see CommitLogReader)."""
 
-        spec = self.get_commits_spec('old', reference_change)
-        return git_rev_list(spec)
+        return self.__commit_log_reader.generate(sha1)
 
     def send_emails(self, mailer, body_filter=None):
         """Use send all of the notification emails needed for this push.
@@ -3703,19 +6034,86 @@ class Push(object):
         it to filter the lines that are intended for the email
         body."""
 
+        logger = self.environment.get_logger()
+        if logger.isEnabledFor(logging.DEBUG):
+            # Finding the state of the commit-graph costs a few git
+            # commands and a stat() per pack.
+            logger.debug(
+                'Push: commit-graph is %s, bitmap index is %s' % (
+                    get_commit_graph_state(),
+                    self.environment.use_bitmap_index and 'used' or 'not used',
+                    ))
+
         # The sha1s of commits that were introduced by this push.
         # They will be removed from this set as they are processed, to
         # guarantee that one (and only one) email is generated for
         # each new commit.
         unhandled_sha1s = set(self.get_new_commits())
-        send_date = IncrementalDateTime()
+        commit_infos = self.get_commit_infos(unhandled_sha1s)
+
+        # The new commits to be handled with each change (see
+        # get_handled_commits()), and the Revisions whose emails are
+        # sent for them (None if no commit emails are sent).  The
+        # Revisions are all claimed before any email is generated, so
+        # that the reference change emails list exactly the commits
+        # whose emails are not sent as "notified":
+        changes_sha1s = []
+        # The commits whose emails will be generated, in order:
+        email_sha1s = []
         for change in self.changes:
             sha1s = []
-            for sha1 in reversed(list(self.get_new_commits(change))):
-                if sha1 in unhandled_sha1s:
+            rebased_sha1s = self.get_rebased_commits(change)
+            for sha1 in reversed(self.get_handled_commits(change)):
+                if sha1 not in rebased_sha1s:
                     sha1s.append(sha1)
-                    unhandled_sha1s.remove(sha1)
+                unhandled_sha1s.discard(sha1)
+
+            max_emails = change.environment.maxcommitemails
+            if max_emails and len(sha1s) > max_emails:
+                changes_sha1s.append((change, sha1s, None))
+                if change.environment.max_commit_emails_action == 'digest':
+                    # A digest is sent instead of the commit emails:
+                    continue
+                break
+            revisions = self._claim_revisions(change, sha1s, commit_infos)
+            changes_sha1s.append((change, sha1s, revisions))
+            email_sha1s.extend(rev.rev.sha1 for rev in revisions)
+
+        if self.environment.render_jobs > 1:
+            # The emails are rendered concurrently, so they cannot
+            # share one stream; each one runs its own "git log".
+            email_sha1s = []
+        self.__commit_log_reader = CommitLogReader(
+            email_sha1s, self.environment.commitlogopts,
+            self.environment.get_email_max_line_length(),
+            )
+        try:
+            completed = self._send_emails(mailer, changes_sha1s, commit_infos, body_filter)
+        finally:
+            self.__commit_log_reader.close()
+            self._close_commit_info_cache()
+            self._release_unsent_claims()
+            self.environment.get_logger().debug(
+                'Push: git output cache: %s' % (GIT_OUTPUT_CACHE.get_stats(),))
+            GIT_OUTPUT_CACHE.clear()
+
+        # Consistency check:
+        if completed and unhandled_sha1s:
+            self.environment.log_error(
+                'ERROR: No emails were sent for the following new commits:\n'
+                '    %s'
+                % ('\n    '.join(sorted(unhandled_sha1s)),)
+                )
+
+    def _send_emails(self, mailer, changes_sha1s, commit_infos, body_filter):
+        """Send the emails for each (change, sha1s, revisions) in changes_sha1s.
+
+        Return False if sending was stopped because a change has more
+        than multimailhook.maxCommitEmails new commits (unless
+        multimailhook.maxCommitEmailsAction is "digest")."""
 
+        send_date = IncrementalDateTime()
+        for (change, sha1s, revisions) in changes_sha1s:
             # Check if we've got anyone to send to
             if not change.recipients:
                 change.environment.log_warning(
@@ -3729,12 +6127,15 @@ class Push(object):
                         'Sending notification emails to: %s' % (change.recipients,))
                 extra_values = {'send_date': next(send_date)}
 
-                rev = change.send_single_combined_email(sha1s)
+                rev = change.send_single_combined_email(sha1s, push=self)
+                if rev and rev.rev.sha1 in self.__announced_commits:
+                    rev = None
                 if rev:
                     mailer.send(
                         change.generate_combined_email(self, rev, body_filter, extra_values),
                         rev.recipients,
                         )
+                    self._mark_claim_sent(rev)
                     # This change is now fully handled; no need to handle
                     # individual revisions any further.
                     continue
@@ -3745,52 +6146,865 @@ class Push(object):
                         )
 
             max_emails = change.environment.maxcommitemails
+            if (max_emails and len(sha1s) > max_emails and
+                    change.environment.max_commit_emails_action == 'digest'):
+                digest = CommitDigest(change, sha1s, commit_infos)
+                if digest.recipients:
+                    change.environment.log_msg(
+                        '*** Too many new commits (%d), sending a digest instead of '
+                        'commit emails.' % len(sha1s))
+                    mailer.send(
+                        digest.generate_email(
+                            self, body_filter, {'send_date': next(send_date)},
+                            ),
+                        digest.recipients,
+                        )
+                continue
             if max_emails and len(sha1s) > max_emails:
                 change.environment.log_warning(
                     '*** Too many new commits (%d), not sending commit emails.\n' % len(sha1s) +
                     '*** Try setting multimailhook.maxCommitEmails to a greater value\n' +
                     '*** Currently, multimailhook.maxCommitEmails=%d' % max_emails
                     )
-                return
+                return False
 
-            for (num, sha1) in enumerate(sha1s):
-                rev = Revision(change, GitObject(sha1), num=num + 1, tot=len(sha1s))
-                if len(rev.parents) > 1 and change.environment.excludemergerevisions:
-                    # skipping a merge commit
-                    continue
-                if not rev.recipients and rev.cc_recipients:
-                    change.environment.log_msg('*** Replacing Cc: with To:')
-                    rev.recipients = rev.cc_recipients
-                    rev.cc_recipients = None
-                if rev.recipients:
-                    extra_values = {'send_date': next(send_date)}
-                    mailer.send(
-                        rev.generate_email(self, body_filter, extra_values),
-                        rev.recipients,
-                        )
+            revisions = self._generate_revisions(revisions, send_date)
+            if self.environment.render_jobs > 1:
+                emails = self._render_concurrently(
+                    revisions, body_filter, self.environment.render_jobs,
+                    )
+            else:
+                emails = (
+                    (rev, rev.generate_email(self, body_filter, extra_values))
+                    for (rev, extra_values) in revisions
+                    )
+            for (rev, lines) in emails:
+                mailer.send(lines, rev.recipients)
+                self._mark_claim_sent(rev)
 
-        # Consistency check:
-        if unhandled_sha1s:
-            change.environment.log_error(
-                'ERROR: No emails were sent for the following new commits:\n'
-                '    %s'
-                % ('\n    '.join(sorted(unhandled_sha1s)),)
-                )
+        return True
 
+    def _claim_announcement(self, rev):
+        """Return True if the email of rev should be sent.
 
-def include_ref(refname, ref_filter_regex, is_inclusion_filter):
-    does_match = bool(ref_filter_regex.search(refname))
-    if is_inclusion_filter:
-        return does_match
-    else:  # exclusion filter -- we include the ref if the regex doesn't match
-        return not does_match
+        Return False if rev was already announced to its recipients
+        (see AnnouncementRegistry); otherwise, record that it is."""
 
+        registry = self._get_announcement_registry()
+        if registry is None:
+            return True
+        try:
+            if not registry.claim(rev.recipients, rev.rev.sha1):
+                self.environment.get_logger().debug(
+                    'Push: %s was already announced to %s' % (rev.rev.sha1, rev.recipients))
+                return False
+        except sqlite3.Error as e:
+            self.environment.log_warning(
+                '*** Cannot use multimailhook.announcedCommitsFile: %s\n' % (e,))
+            self._close_announcement_registry()
+            return True
+        self.__unsent_claims.add((rev.recipients, rev.rev.sha1))
+        return True
 
-def run_as_post_receive_hook(environment, mailer):
-    environment.check()
-    send_filter_regex, send_is_inclusion_filter = environment.get_ref_filter_regex(True)
+    def _mark_claim_sent(self, rev):
+        claim = (rev.recipients, rev.rev.sha1)
+        if claim in self.__unsent_claims:
+            self.__unsent_claims.remove(claim)
+            self.__sent_claims.add(claim)
+
+    def get_announced_commits(self, change, sha1s):
+        """Return the set of the sha1s already announced.
+
+        sha1s are new commits of change.  Return those that were
+        already announced to the recipients of their emails, or are
+        being announced to them by another hook (see
+        AnnouncementRegistry), and for which no email is thus sent.
+        The commits are claimed by send_emails() before any email is
+        generated."""
+
+        return set(sha1 for sha1 in sha1s if sha1 in self.__announced_commits)
+
+    def _get_announcement_registry(self):
+        """Return the AnnouncementRegistry to use, or None.
+
+        The registry is opened the first time it is needed.  If it
+        cannot be used, a warning is logged once and None is
+        returned."""
+
+        if self.__announcement_registry is None:
+            self.__announcement_registry = False
+            if not self.environment.announced_commits_file:
+                pass
+            elif sqlite3 is None:
+                self.environment.log_warning(
+                    '*** multimailhook.announcedCommitsFile is not supported by this Python.\n')
+            else:
+                try:
+                    self.__announcement_registry = AnnouncementRegistry(
+                        self.environment.announced_commits_file,
+                        self.environment.announced_commits_max_age * 24 * 3600,
+                        )
+                except sqlite3.Error as e:
+                    self.environment.log_warning(
+                        '*** Cannot use multimailhook.announcedCommitsFile: %s\n' % (e,))
+        return self.__announcement_registry or None
+
+    def _release_unsent_claims(self):
+        if self.__announcement_registry and self.__unsent_claims:
+            try:
+                self.__announcement_registry.release(self.__unsent_claims)
+            except sqlite3.Error as e:
+                self.environment.log_warning(
+                    '*** Cannot use multimailhook.announcedCommitsFile: %s\n' % (e,))
+        self.__unsent_claims = set()
+
+    def confirm_announcements(self, delivered):
+        """Confirm or release the claims of the emails sent by send_emails().
+
+        This method must be called once the mailer passed to
+        send_emails() is closed; delivered tells whether it was closed
+        successfully, i.e., whether the emails were delivered.  The
+        claims of the emails that were delivered are confirmed, and the
+        others are released (see AnnouncementRegistry)."""
+
+        if self.__announcement_registry:
+            try:
+                if delivered:
+                    self.__announcement_registry.confirm(self.__sent_claims)
+                else:
+                    self.__unsent_claims.update(self.__sent_claims)
+                self.__sent_claims = set()
+                self.__announcement_registry.prune()
+            except sqlite3.Error as e:
+                self.environment.log_warning(
+                    '*** Cannot use multimailhook.announcedCommitsFile: %s\n' % (e,))
+        self._close_announcement_registry()
+
+    def _close_announcement_registry(self):
+        """Close the registry, releasing the claims of undelivered emails."""
+
+        self.__unsent_claims.update(self.__sent_claims)
+        self._release_unsent_claims()
+        if self.__announcement_registry:
+            self.__announcement_registry.close()
+        self.__announcement_registry = False
+        self.__sent_claims = set()
+
+    def _claim_revisions(self, change, sha1s, commit_infos):
+        """Return the list of the Revisions whose emails are sent.
+
+        sha1s are the new commits to be sent with change.  Commits
+        that are excluded or have no recipients are skipped.  The
+        others are claimed (see AnnouncementRegistry), and those
+        already announced to their recipients are skipped too, and
+        remembered (see get_announced_commits())."""
+
+        revisions = []
+        for (num, sha1) in enumerate(sha1s):
+            info = commit_infos[sha1]
+            if len(info.parents) > 1 and change.environment.excludemergerevisions:
+                # skipping a merge commit
+                continue
+            rev = Revision(
+                change, GitObject(sha1, type='commit', short=info.sha1_short),
+                num=num + 1, tot=len(sha1s), info=info,
+                )
+            if not rev.recipients and rev.cc_recipients:
+                change.environment.log_msg('*** Replacing Cc: with To:')
+                rev.recipients = rev.cc_recipients
+                rev.cc_recipients = None
+            if not rev.recipients:
+                continue
+            if self._claim_announcement(rev):
+                revisions.append(rev)
+            else:
+                self.__announced_commits.add(sha1)
+        return revisions
+
+    def _generate_revisions(self, revisions, send_date):
+        """Iterate over (Revision, extra_values) for the emails to send.
+
+        revisions are the Revisions returned by _claim_revisions().
+        extra_values contain the send date of each email."""
+
+        for rev in revisions:
+            yield (rev, {'send_date': next(send_date)})
+
+    def _render_concurrently(self, revisions, body_filter, jobs):
+        """Render the emails of revisions using jobs threads.
+
+        revisions is an iterable over (Revision, extra_values).
+        Iterate over (Revision, lines) in the same order, where lines
+        iterates over the lines of the email as they are rendered; it
+        must be consumed before the next item is requested.  At most
+        2 * jobs emails are rendered ahead of the one being consumed,
+        and each of them is only rendered RenderBuffer.MAX_LINES lines
+        ahead, so that large emails are still streamed."""
+
+        from multiprocessing.pool import ThreadPool
+
+        def render(rev, extra_values, buf):
+            lines = rev.generate_email(self, body_filter, extra_values)
+            try:
+                for line in lines:
+                    buf.put(line)
+            except RenderBuffer.Cancelled:
+                pass
+            except Exception:
+                buf.finish(sys.exc_info()[1])
+            else:
+                buf.finish()
+            finally:
+                lines.close()
+
+        pool = ThreadPool(jobs)
+        pending = []
+        try:
+            for (rev, extra_values) in revisions:
+                buf = RenderBuffer()
+                pool.apply_async(render, (rev, extra_values, buf))
+                pending.append((rev, buf))
+                if len(pending) >= 2 * jobs:
+                    yield pending.pop(0)
+            while pending:
+                yield pending.pop(0)
+        finally:
+            for (rev, buf) in pending:
+                buf.cancel()
+            pool.terminate()
+            pool.join()
+
+
+# The estimated number of loose objects written after the
+# commit-graph above which update_commit_graph() writes it again:
+COMMIT_GRAPH_LOOSE_OBJECTS = 1000
+
+
+def count_new_loose_objects(objects_dir, since):
+    """Estimate the number of loose objects modified after the time since.
+
+    Like "git gc --auto", only look at the objects of one fan-out
+    directory, and assume that the others hold as many."""
+
+    fanout_dir = os.path.join(objects_dir, '17')
+    try:
+        names = os.listdir(fanout_dir)
+    except OSError:
+        return 0
+    count = 0
+    for name in names:
+        try:
+            if os.path.getmtime(os.path.join(fanout_dir, name)) > since:
+                count += 1
+        except OSError:
+            # The object was packed and pruned meanwhile.
+            pass
+    return count * 256
+
+
+def get_commit_graph_state():
+    """Return the state of the commit-graph of the repository.
+
+    The commit-graph makes the walks of "git rev-list" much faster.
+    Return 'disabled' if core.commitGraph is false, 'missing' if there
+    is no commit-graph, 'stale' if a pack was written after it or if
+    more than COMMIT_GRAPH_LOOSE_OBJECTS loose objects (which small
+    pushes are unpacked to, see receive.unpackLimit) were, and
+    'present' otherwise.  A few loose commits missing from the
+    commit-graph barely slow git down, whereas writing it after each
+    small push would cost more than it saves."""
+
+    if not Config('core').get_bool('commitGraph', default=True):
+        return 'disabled'
+    info_dir = read_git_output(['rev-parse', '--git-path', 'objects/info'])
+    graph_mtime = None
+    for path in [
+            os.path.join(info_dir, 'commit-graph'),
+            os.path.join(info_dir, 'commit-graphs', 'commit-graph-chain'),
+            ]:
+        if os.path.exists(path):
+            graph_mtime = max(graph_mtime or 0, os.path.getmtime(path))
+    if graph_mtime is None:
+        return 'missing'
+    objects_dir = os.path.dirname(info_dir)
+    pack_dir = os.path.join(objects_dir, 'pack')
+    if os.path.isdir(pack_dir):
+        for name in os.listdir(pack_dir):
+            if (name.endswith('.pack') and
+                    os.path.getmtime(os.path.join(pack_dir, name)) > graph_mtime):
+                return 'stale'
+    if count_new_loose_objects(objects_dir, graph_mtime) > COMMIT_GRAPH_LOOSE_OBJECTS:
+        return 'stale'
+    return 'present'
+
+
+def update_commit_graph(environment):
+    """Start writing the commit-graph if it is missing or stale.
+
+    The commit-graph is written incrementally (with "--split"), so
+    that only the commits missing from it are added, by a background
+    git process that the hook does not wait for.  If another one is
+    still running, git fails to take the lock of the commit-graph and
+    leaves it to the running one."""
+
+    state = get_commit_graph_state()
+    if state in ('missing', 'stale'):
+        environment.get_logger().debug(
+            'update_commit_graph: commit-graph is %s, writing it in the background' % (state,))
+        choose_git_command()
+        kw = {}
+        if PYTHON3:
+            kw['start_new_session'] = True
+        elif hasattr(os, 'setsid'):
+            kw['preexec_fn'] = os.setsid
+        null = open(os.devnull, 'r+b')
+        try:
+            subprocess.Popen(
+                tuple(str_to_bytes(w) for w in GIT_CMD + [
+                    'commit-graph', 'write', '--reachable', '--split',
+                    ]),
+                stdin=null, stdout=null, stderr=null, close_fds=True, **kw
+                )
+        finally:
+            null.close()
+
+
+def peel_to_commit(sha1):
+    """Return the SHA-1 of the commit sha1 points at, maybe via tags.
+
+    Return None if sha1 is ZEROS or does not point at a commit."""
+
+    if sha1 == ZEROS:
+        return None
+    info = read_object_info('%s^0' % (sha1,))
+    if info is None or info[1] != 'commit':
+        return None
+    return info[0]
+
+
+def reduce_commits(sha1s, chunk_size=1000):
+    """Return the commits of sha1s that are not reachable from the others.
+
+    Other commits of sha1s are reachable from the ones returned.  The
+    commits are reduced by "git merge-base --independent", chunk_size
+    commits at a time to keep its command line short."""
+
+    sha1s = sorted(set(sha1s))
+    while len(sha1s) > 1:
+        reduced = set()
+        for i in range(0, len(sha1s), chunk_size):
+            reduced.update(read_git_lines(
+                ['merge-base', '--independent'] + sha1s[i:i + chunk_size]
+                ))
+        done = len(sha1s) <= chunk_size or len(reduced) == len(sha1s)
+        sha1s = sorted(reduced)
+        if done:
+            break
+    return sha1s
+
+
+class RefSnapshot(object):
+    """A snapshot of the references, as of the end of the last push.
+
+    The snapshot is a file recording, as of the end of the last push
+    processed by the post-receive hook:
+
+    * a few "tips": the commits pointed at by the references included
+      by the reference filter, reduced to the ones that are not
+      reachable from the others (see reduce_commits()).  The commits
+      that were in the repository before the next push are the ones
+      reachable from the tips, so that push can exclude them instead
+      of all the references.
+
+    * the inode and modification time of the packed-refs file and of
+      each loose reference file included by the filter, which are
+      cheap to compare to the current ones.
+
+    The snapshot is stale, and the references are listed as usual, if
+    a reference was changed other than by the push being processed:
+    i.e., if packed-refs changed, if a loose reference not updated by
+    the push changed, or if a reference updated by the push does not
+    point at its pushed value anymore.  It is not used either for
+    pushes deleting references or discarding commits, as commits
+    reachable from the tips would then not be in the repository
+    anymore.  After such a push, the snapshot is written again from
+    the list of references; otherwise, the pushed values are added to
+    its tips.
+
+    Only the "files" reference backend is supported."""
+
+    HEADER = 'git-multimail ref snapshot 2'
+
+    def __init__(self, path, ref_filter_regex, is_inclusion_filter):
+        self.path = path
+        self.ref_filter_regex = ref_filter_regex
+        self.is_inclusion_filter = is_inclusion_filter
+        # The snapshot is stale if the filter changed:
+        self.filter_line = 'filter %s %s' % (
+            is_inclusion_filter and 'include' or 'exclude', ref_filter_regex.pattern,
+            )
+        self.git_dir = get_git_dir()
+
+    @staticmethod
+    def _stat(path):
+        """Return a string identifying the version of the file at path."""
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return '-'
+        return '%d:%s:%d' % (
+            st.st_ino, getattr(st, 'st_mtime_ns', repr(st.st_mtime)), st.st_size,
+            )
+
+    def _scan(self):
+        """Return (packed, loose) describing the current reference files.
+
+        packed identifies the version of packed-refs, and loose is
+        {refname: version} for the loose references included by the
+        filter.  Return None if the references are not stored as
+        files."""
+
+        if os.path.isdir(os.path.join(self.git_dir, 'reftable')):
+            return None
+        (refdirs, excluded) = self._get_refdirs()
+        loose = {}
+        for top in refdirs:
+            for (dirpath, dirnames, filenames) in os.walk(os.path.join(self.git_dir, top)):
+                refdir = os.path.relpath(dirpath, self.git_dir).replace(os.sep, '/')
+                # Don't descend into the namespaces excluded by the
+                # filter (e.g., Gerrit's refs/changes/):
+                dirnames[:] = [
+                    dirname for dirname in dirnames
+                    if not [prefix for prefix in excluded
+                            if (refdir + '/' + dirname + '/').startswith(prefix)]
+                    ]
+                for filename in filenames:
+                    if filename.endswith('.lock'):
+                        continue
+                    refname = refdir + '/' + filename
+                    if include_ref(refname, self.ref_filter_regex, self.is_inclusion_filter):
+                        loose[refname] = self._stat(os.path.join(dirpath, filename))
+        return (self._stat(os.path.join(self.git_dir, 'packed-refs')), loose)
+
+    def _get_refdirs(self):
+        """Return (refdirs, excluded) limiting the loose references to scan.
+
+        refdirs are the directories (relative to GIT_DIR) that can
+        contain references included by the filter, and excluded the
+        prefixes of the directories inside them that cannot.  When the
+        filter is not made of literal prefixes (see
+        ref_filter_globs()), the whole of refs/ is scanned."""
+
+        globs = ref_filter_globs(self.ref_filter_regex, self.is_inclusion_filter)
+        if globs is None:
+            return (['refs'], [])
+        prefixes = [glob[:-1] for glob in globs if glob.endswith('*')]
+        if not self.is_inclusion_filter:
+            return (['refs'], prefixes)
+        refdirs = set()
+        for prefix in prefixes:
+            refdir = prefix[:prefix.rfind('/')]
+            if not refdir.startswith('refs/'):
+                return (['refs'], [])
+            refdirs.add(refdir)
+        # Don't scan directories twice:
+        return (
+            sorted(
+                refdir for refdir in refdirs
+                if not [other for other in refdirs if refdir.startswith(other + '/')]
+                ),
+            [],
+            )
+
+    def _read(self):
+        """Return (tips, packed, loose) from the snapshot, or None if missing."""
+
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return None
+        try:
+            lines = [bytes_to_str(line).rstrip('\n') for line in f]
+        finally:
+            f.close()
+        if lines[:2] != [self.HEADER, self.filter_line]:
+            return None
+        tips = []
+        packed = None
+        loose = {}
+        for line in lines[2:]:
+            words = line.split(' ', 2)
+            if words[0] == 'tip':
+                tips.append(words[1])
+            elif words[0] == 'packed':
+                packed = words[1]
+            elif words[0] == 'loose':
+                loose[words[2]] = words[1]
+        return (tips, packed, loose)
+
+    def _check(self, snapshot, scan, updates):
+        """Tell whether snapshot is up to date, except for updates.
+
+        updates is a list of (refname, oldrev, newrev), which must not
+        delete references or discard commits: the old value of each
+        reference must still be reachable from the new value of one of
+        them.  This is checked last, with a single "git merge-base
+        --independent" for all the updates (see reduce_commits())."""
+
+        if snapshot is None or scan is None:
+            return False
+        (tips, packed, loose) = snapshot
+        (current_packed, current_loose) = scan
+        if current_packed != packed:
+            return False
+        updated = {}
+        old_sha1s = set()
+        new_sha1s = set()
+        for (refname, oldrev, newrev) in updates:
+            if newrev == ZEROS:
+                return False
+            if oldrev != ZEROS:
+                old_sha1 = peel_to_commit(oldrev)
+                if old_sha1:
+                    new_sha1 = peel_to_commit(newrev)
+                    if not new_sha1:
+                        return False
+                    old_sha1s.add(old_sha1)
+                    new_sha1s.add(new_sha1)
+            updated[refname] = newrev
+        for refname in set(loose) | set(current_loose):
+            if refname in updated:
+                try:
+                    f = open(os.path.join(self.git_dir, refname), 'rb')
+                    try:
+                        value = bytes_to_str(f.read()).strip()
+                    finally:
+                        f.close()
+                except IOError:
+                    return False
+                if value != updated[refname]:
+                    return False
+            elif loose.get(refname) != current_loose.get(refname):
+                return False
+        old_sha1s -= new_sha1s
+        if old_sha1s:
+            # Every commit passed to reduce_commits() is reachable from
+            # one it returns, so the old values it drops are reachable
+            # from the new ones:
+            if old_sha1s & set(reduce_commits(old_sha1s | new_sha1s)):
+                return False
+        return True
+
+    def get_other_ref_tips(self, updates, updated_refnames):
+        """Return tips from which the commits of the other references are reachable.
+
+        updates is the list of (refname, oldrev, newrev) of this push,
+        and updated_refnames the references of the ReferenceChanges
+        sent.  Return the SHA-1s to exclude instead of the references
+        not in updated_refnames (see Push), or None if the snapshot is
+        missing or stale, or cannot be used for this push."""
+
+        snapshot = self._read()
+        if not self._check(snapshot, self._scan(), updates):
+            return None
+        tips = set(snapshot[0])
+        # The references updated without sending emails are other
+        # references too:
+        updated_refnames = set(updated_refnames)
+        for (refname, oldrev, newrev) in updates:
+            if refname not in updated_refnames:
+                sha1 = peel_to_commit(newrev)
+                if sha1:
+                    tips.add(sha1)
+        return tips
+
+    def _list_ref_sha1s(self):
+        """Return the commits pointed at by the current references."""
+
+        sha1s = set()
+        fmt = (
+            '%(objectname) %(objecttype) %(refname)\n'
+            '%(*objectname) %(*objecttype) %(refname)'
+            )
+        for line in read_git_lines(['for-each-ref', '--format=%s' % (fmt,)]):
+            (sha1, type, name) = line.split(' ', 2)
+            if (sha1 and type == 'commit' and
+                    include_ref(name, self.ref_filter_regex, self.is_inclusion_filter)):
+                sha1s.add(sha1)
+        return sha1s
+
+    def update(self, updates):
+        """Add updates to the snapshot, or write it again if stale.
+
+        The snapshot is read again and replaced atomically under a
+        lock, so that the updates of concurrent pushes are kept."""
+
+        lock = os.open(self.path + '.lock', os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            scan = self._scan()
+            if scan is None:
+                return
+            snapshot = self._read()
+            if self._check(snapshot, scan, updates):
+                tips = set(snapshot[0])
+                for (refname, oldrev, newrev) in updates:
+                    sha1 = peel_to_commit(newrev)
+                    if sha1:
+                        tips.add(sha1)
+            else:
+                # Scan the files before listing the references, so that
+                # references changed in between make the snapshot stale.
+                tips = self._list_ref_sha1s()
+            (packed, loose) = scan
+            tmp_path = '%s.%d' % (self.path, os.getpid())
+            f = open(tmp_path, 'wb')
+            try:
+                f.write(str_to_bytes(self.HEADER + '\n' + self.filter_line + '\n'))
+                for sha1 in reduce_commits(tips):
+                    f.write(str_to_bytes('tip %s\n' % (sha1,)))
+                f.write(str_to_bytes('packed %s\n' % (packed,)))
+                for refname in sorted(loose):
+                    f.write(str_to_bytes('loose %s %s\n' % (loose[refname], refname)))
+            finally:
+                f.close()
+            os.rename(tmp_path, self.path)
+        finally:
+            os.close(lock)
+
+
+def read_spooled_email(f):
+    """Read the email written by SpoolMailer to the file object f.
+
+    Return (to_addrs, lines), where lines iterates over the remaining
+    contents of f."""
+
+    to_addrs = []
+    while True:
+        line = bytes_to_str(f.readline())
+        if not line.startswith(SpoolMailer.ENVELOPE_TO):
+            break
+        to_addrs.append(line[len(SpoolMailer.ENVELOPE_TO):].rstrip('\n'))
+    if line != '\n':
+        raise ValueError('malformed spooled email: %r' % (line,))
+    return (to_addrs, (bytes_to_str(line) for line in f))
+
+
+# The suffix added to the name of a spooled email that could not be
+# sent, counting the failed attempts:
+SPOOL_ATTEMPTS_RE = re.compile(r',A([0-9]+)$')
+
+# Errors that are specific to a spooled email, and would happen again
+# if it were retried:
+SPOOL_PERMANENT_ERRORS = (ValueError, smtplib.SMTPRecipientsRefused)
+
+
+def lock_spooled_email(path):
+    """Open the spooled email at path and lock it.
+
+    Return the file object, or None if the file does not exist anymore
+    or is locked by another delivery.  The lock is released when the
+    file is closed (or the process exits)."""
+
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        return None
+    if fcntl is not None:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            f.close()
+            return None
+    return f
+
+
+def reclaim_spool(environment, spooldir, stale_age=3600):
+    """Move the emails left in 'cur' by interrupted deliveries to 'new'.
+
+    An email is being delivered as long as its file is locked.  If
+    file locks are not available, emails claimed more than stale_age
+    seconds ago are considered abandoned instead."""
+
+    new_dir = os.path.join(spooldir, 'new')
+    cur_dir = os.path.join(spooldir, 'cur')
+    for name in sorted(os.listdir(cur_dir)):
+        cur_path = os.path.join(cur_dir, name)
+        f = lock_spooled_email(cur_path)
+        if f is None:
+            continue
+        try:
+            try:
+                if fcntl is None and time.time() - os.stat(cur_path).st_ctime < stale_age:
+                    continue
+                os.rename(cur_path, os.path.join(new_dir, name))
+            except OSError:
+                # Sent or reclaimed by a concurrent delivery.
+                continue
+        finally:
+            f.close()
+        environment.get_logger().warning(
+            '*** Spooled email %s was claimed by an interrupted delivery\n' % (name,) +
+            '***  - it will be sent again and may be received twice.\n'
+            )
+
+
+def deliver_spool(environment, mailer, spooldir, max_attempts=10):
+    """Send the emails written to spooldir by SpoolMailer using mailer.
+
+    Emails are sent in the order they were spooled.  Each one is first
+    claimed by locking its file and moving it from 'new' to 'cur', so
+    that concurrent deliveries of the same spool never send an email
+    twice, and removed once sent.  Emails left in 'cur' by an
+    interrupted delivery are moved back to 'new' first (see
+    reclaim_spool()); they may thus be received twice.
+
+    An email that cannot be sent because of its contents (e.g., it is
+    malformed or all its recipients are refused) is moved to 'failed'
+    and the delivery continues.  If sending fails otherwise, the
+    mailer may not be usable anymore: the email is moved back to 'new'
+    and not retried before a delay growing with the number of failed
+    attempts, and the delivery stops.  After max_attempts failed
+    attempts, the email is moved to 'failed'."""
+
+    logger = environment.get_logger()
+    new_dir = os.path.join(spooldir, 'new')
+    cur_dir = os.path.join(spooldir, 'cur')
+    failed_dir = os.path.join(spooldir, 'failed')
+    try:
+        reclaim_spool(environment, spooldir)
+        for name in sorted(os.listdir(new_dir)):
+            new_path = os.path.join(new_dir, name)
+            cur_path = os.path.join(cur_dir, name)
+            try:
+                if os.stat(new_path).st_mtime > time.time():
+                    # Waiting before being retried.
+                    continue
+            except OSError:
+                continue
+            f = lock_spooled_email(new_path)
+            if f is None:
+                continue
+            try:
+                try:
+                    os.rename(new_path, cur_path)
+                except OSError:
+                    # Claimed by a concurrent delivery.
+                    continue
+                try:
+                    (to_addrs, lines) = read_spooled_email(f)
+                    mailer.send(lines, to_addrs)
+                except SPOOL_PERMANENT_ERRORS:
+                    logger.error(
+                        '*** Error while sending spooled email %s\n' % (name,) +
+                        '*** %s\n' % (sys.exc_info()[1],) +
+                        '***  - it is moved to %s.\n' % (failed_dir,)
+                        )
+                    os.rename(cur_path, os.path.join(failed_dir, name))
+                    continue
+                except:
+                    m = SPOOL_ATTEMPTS_RE.search(name)
+                    if m:
+                        attempts = int(m.group(1)) + 1
+                        base_name = name[:m.start()]
+                    else:
+                        attempts = 1
+                        base_name = name
+                    if attempts >= max_attempts:
+                        logger.error(
+                            '*** Error while sending spooled email %s\n' % (name,) +
+                            '***  - giving up after %d attempts, ' % (attempts,) +
+                            'it is moved to %s.\n' % (failed_dir,)
+                            )
+                        os.rename(cur_path, os.path.join(failed_dir, name))
+                    else:
+                        delay = min(60 * 2 ** (attempts - 1), 3600)
+                        logger.error(
+                            '*** Error while sending spooled email %s\n' % (name,) +
+                            '***  - it will be retried in %d seconds.\n' % (delay,)
+                            )
+                        retry_time = time.time() + delay
+                        os.utime(cur_path, (retry_time, retry_time))
+                        os.rename(
+                            cur_path,
+                            os.path.join(new_dir, '%s,A%d' % (base_name, attempts)),
+                            )
+                    raise
+                # Remove the file before releasing the lock, so that
+                # it cannot be reclaimed once sent.
+                os.unlink(cur_path)
+            finally:
+                f.close()
+    finally:
+        mailer.close()
+
+
+# An alternative of a reference filter regex that can be expressed as
+# a glob: "^" followed by a literal prefix, and "$" if the whole
+# refname must match:
+REF_FILTER_LITERAL_RE = re.compile(r'^\^((?:[\w/-]|\\[.+/-])+)(\$?)$')
+
+
+def ref_filter_globs(ref_filter_regex, is_inclusion_filter):
+    """Return globs matching the refnames matched by ref_filter_regex.
+
+    Return a list of patterns for the "--exclude" (or, for an inclusion
+    filter, "--glob") options of "git rev-list", or None if the regex
+    cannot be expressed this way.  Only alternatives of literal
+    prefixes anchored with "^" (e.g. "^refs/notes/|^refs/changes/"),
+    or of whole refnames for exclusion filters, are supported."""
+
+    globs = []
+    for alternative in ref_filter_regex.pattern.split('|'):
+        m = REF_FILTER_LITERAL_RE.match(alternative)
+        if not m:
+            return None
+        literal = re.sub(r'\\(.)', r'\1', m.group(1))
+        if not m.group(2):
+            globs.append(literal + '*')
+        elif is_inclusion_filter:
+            # "--glob" would match the references below it instead.
+            return None
+        else:
+            globs.append(literal)
+    return globs
+
+
+def include_ref(refname, ref_filter_regex, is_inclusion_filter):
+    does_match = bool(ref_filter_regex.search(refname))
+    if is_inclusion_filter:
+        return does_match
+    else:  # exclusion filter -- we include the ref if the regex doesn't match
+        return not does_match
+
+
+def send_push_emails(environment, push, mailer):
+    """Send the emails of push with mailer, and close mailer.
+
+    The commits announced by the emails are only recorded as such (see
+    Push.confirm_announcements()) if mailer is closed successfully."""
+
+    try:
+        push.send_emails(mailer, body_filter=environment.filter_body)
+    finally:
+        delivered = False
+        try:
+            mailer.close()
+            delivered = True
+        finally:
+            push.confirm_announcements(delivered)
+
+
+def run_as_post_receive_hook(environment, mailer):
+    environment.check()
+    send_filter_regex, send_is_inclusion_filter = environment.get_ref_filter_regex(True)
     ref_filter_regex, is_inclusion_filter = environment.get_ref_filter_regex(False)
     changes = []
+    # The (refname, oldrev, newrev) of the references included by the
+    # ref filter, whether emails are sent for them or not:
+    updates = []
     while True:
         line = read_line(sys.stdin)
         if line == '':
@@ -3802,19 +7016,118 @@ def run_as_post_receive_hook(environment, mailer):
 
         if not include_ref(refname, ref_filter_regex, is_inclusion_filter):
             continue
+        updates.append((refname, oldrev, newrev))
         if not include_ref(refname, send_filter_regex, send_is_inclusion_filter):
             continue
         changes.append(
             ReferenceChange.create(environment, oldrev, newrev, refname)
             )
+    ref_snapshot = None
+    if environment.ref_snapshot_file:
+        ref_snapshot = RefSnapshot(
+            environment.ref_snapshot_file, ref_filter_regex, is_inclusion_filter,
+            )
     if not changes:
         mailer.close()
+        if ref_snapshot:
+            ref_snapshot.update(updates)
+        close_cat_file_batch()
         return
-    push = Push(environment, changes)
+    other_ref_tips = None
+    if ref_snapshot:
+        other_ref_tips = ref_snapshot.get_other_ref_tips(
+            updates, [change.refname for change in changes],
+            )
+        if other_ref_tips is None:
+            environment.get_logger().debug(
+                "run_as_post_receive_hook: %s is missing or stale, listing references" %
+                (environment.ref_snapshot_file,))
+        else:
+            environment.get_logger().debug(
+                "run_as_post_receive_hook: excluding %d tips from %s" %
+                (len(other_ref_tips), environment.ref_snapshot_file,))
+    push = Push(environment, changes, other_ref_tips=other_ref_tips)
+    if environment.detach:
+        push.read_references()
+        detach(environment)
     try:
-        push.send_emails(mailer, body_filter=environment.filter_body)
+        send_push_emails(environment, push, mailer)
+        if ref_snapshot:
+            ref_snapshot.update(updates)
+        if environment.write_commit_graph:
+            update_commit_graph(environment)
     finally:
-        mailer.close()
+        close_cat_file_batch()
+
+
+def detach(environment):
+    """Continue running in a background process.
+
+    The calling process exits as soon as the background process is
+    started, so that "git push" (which waits for the hook's output to
+    be closed) completes.  The background process is not attached to
+    the hook's session, reads its standard input from /dev/null and
+    appends its output to multimailhook.logFile (or discards it).
+    Background processes of the same repository are serialized by a
+    lock, so that the emails of different pushes are not interleaved;
+    the lock is not fair, so concurrent pushes may be processed in any
+    order.
+
+    Objects shared with the calling process are left alone by the
+    calling process and can still be used by the background process,
+    except for the git commands run in the background, which are
+    closed first.  Connections that could time out while waiting for
+    the lock should not be opened before (see DeferredMailer).  If
+    os.fork() is not available, keep running in the foreground."""
+
+    if not hasattr(os, 'fork'):
+        environment.log_warning(
+            '*** multimailhook.detach is not supported on this platform.\n'
+            )
+        return
+
+    close_cat_file_batch()
+    # Make the background process independent of the working
+    # directory, and of the quarantine directory of the push if git
+    # set one, which is removed when the hook exits:
+    os.environ['GIT_DIR'] = os.path.abspath(get_git_dir())
+    os.environ.pop('GIT_QUARANTINE_PATH', None)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        # Exit without running cleanups, which would also close the
+        # state shared with the background process:
+        os._exit(0)
+
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+
+    null = os.open(os.devnull, os.O_RDWR)
+    if environment.log_file:
+        out = os.open(environment.log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    else:
+        out = null
+    os.dup2(null, 0)
+    os.dup2(out, 1)
+    os.dup2(out, 2)
+
+    lock_repository(os.environ['GIT_DIR'])
+
+
+def lock_repository(git_dir):
+    """Wait for, then take the lock serializing the emails of git_dir.
+
+    The lock is held until the process exits, as the file descriptor
+    is never closed."""
+
+    lock = os.open(os.path.join(git_dir, 'git-multimail.lock'),
+                   os.O_WRONLY | os.O_CREAT, 0o666)
+    if fcntl is not None:
+        fcntl.flock(lock, fcntl.LOCK_EX)
 
 
 def run_as_update_hook(environment, mailer, refname, oldrev, newrev, force_send=False):
@@ -3835,12 +7148,13 @@ def run_as_update_hook(environment, mailer, refname, oldrev, newrev, force_send=
         ]
     if not changes:
         mailer.close()
+        close_cat_file_batch()
         return
     push = Push(environment, changes, force_send)
     try:
-        push.send_emails(mailer, body_filter=environment.filter_body)
+        send_push_emails(environment, push, mailer)
     finally:
-        mailer.close()
+        close_cat_file_batch()
 
 
 def check_ref_filter(environment):
@@ -3913,12 +7227,22 @@ def check_setup(environment):
 
 
 def choose_mailer(config, environment):
-    mailer = config.get('mailer', default='sendmail')
+    name = config.get('mailer', default='sendmail')
+    if name == 'smtp' and getattr(environment, 'detach', False):
+        # Connect to the SMTP server from the background process.
+        mailer = DeferredMailer(lambda: make_mailer(config, environment, name), environment)
+    else:
+        mailer = make_mailer(config, environment, name)
+    if config.get_bool('sendInBackground', default=False):
+        mailer = QueuedMailer(mailer)
+    return mailer
+
 
+def make_mailer(config, environment, mailer):
     if mailer == 'smtp':
         smtpserver = config.get('smtpserver', default='localhost')
         smtpservertimeout = float(config.get('smtpservertimeout', default=10.0))
-        smtpserverdebuglevel = int(config.get('smtpserverdebuglevel', default=0))
+        smtpserverdebuglevel = config.get_int('smtpserverdebuglevel', default=0)
         smtpencryption = config.get('smtpencryption', default='none')
         smtpuser = config.get('smtpuser', default='')
         smtppass = config.get('smtppass', default='')
@@ -3939,12 +7263,22 @@ def choose_mailer(config, environment):
             command = shlex.split(command)
         mailer = SendMailer(environment,
                             command=command, envelopesender=environment.get_sender())
+    elif mailer == 'spool':
+        spooldir = config.get('spooldir')
+        if not spooldir:
+            environment.log_error(
+                'fatal: multimailhook.mailer is set to "spool"\n'
+                'please set multimailhook.spoolDir.'
+                )
+            sys.exit(1)
+        mailer = SpoolMailer(environment, spooldir)
     else:
         environment.log_error(
             'fatal: multimailhook.mailer is set to an incorrect value: "%s"\n' % mailer +
-            'please use one of "smtp" or "sendmail".'
+            'please use one of "smtp", "sendmail" or "spool".'
             )
         sys.exit(1)
+
     return mailer
 
 
@@ -4051,21 +7385,28 @@ def build_environment(environment_klass, env, config,
     return environment_klass(**environment_kw)
 
 
+# The version string computed by get_version(), once it is known:
+VERSION = None
+
+
 def get_version():
-    oldcwd = os.getcwd()
-    try:
+    global VERSION
+
+    if VERSION is None:
+        # Don't change the current directory to run "git describe", as
+        # emails might be rendered concurrently by other threads.
         try:
-            os.chdir(os.path.dirname(os.path.realpath(__file__)))
-            git_version = read_git_output(['describe', '--tags', 'HEAD'])
+            git_version = read_git_output(
+                ['describe', '--tags', 'HEAD'],
+                cwd=os.path.dirname(os.path.realpath(__file__)),
+                )
             if git_version == __version__:
-                return git_version
+                VERSION = git_version
             else:
-                return '%s (%s)' % (__version__, git_version)
+                VERSION = '%s (%s)' % (__version__, git_version)
         except:
-            pass
-    finally:
-        os.chdir(oldcwd)
-    return __version__
+            VERSION = __version__
+    return VERSION
 
 
 def compute_gerrit_options(options, args, required_gerrit_options,
@@ -4178,11 +7519,14 @@ class Logger(object):
         file_handler.setFormatter(log_fmt)
         log_file.addHandler(file_handler)
         log_file.setLevel(verbosity)
+        self.handlers.append((log_file, file_handler))
         return log_file
 
     def __init__(self, environment):
         self.environment = environment
         self.loggers = []
+        # The (logger, handler) pairs added by this object:
+        self.handlers = []
         stderr_log = logging.getLogger('git_multimail.stderr')
 
         class EncodedStderr(object):
@@ -4194,6 +7538,7 @@ class Logger(object):
 
         stderr_handler = logging.StreamHandler(EncodedStderr())
         stderr_log.addHandler(stderr_handler)
+        self.handlers.append((stderr_log, stderr_handler))
         stderr_log.setLevel(self.parse_verbose(environment.verbose))
         self.loggers.append(stderr_log)
 
@@ -4212,6 +7557,24 @@ class Logger(object):
                 environment, 'git_multimail.error', environment.error_log_file, logging.ERROR)
             self.loggers.append(error_log_file)
 
+    def close(self):
+        """Remove the handlers added to the loggers, and close them.
+
+        The loggers are global, so a process handling several pushes
+        (see serve_daemon_worker()) must close the Logger of each push
+        for its messages not to be repeated by the following ones."""
+
+        for (log, handler) in self.handlers:
+            log.removeHandler(handler)
+            handler.close()
+        self.handlers = []
+
+    def isEnabledFor(self, level):
+        for l in self.loggers:
+            if l.isEnabledFor(level):
+                return True
+        return False
+
     def info(self, msg, *args, **kwargs):
         for l in self.loggers:
             l.info(msg, *args, **kwargs)
@@ -4229,6 +7592,457 @@ class Logger(object):
             l.error(msg, *args, **kwargs)
 
 
+# The environment variables that the daemon takes from the requests of
+# git-multimail-client (see Daemon).  The others, including those that
+# set the configuration or the commands run by git (GIT_*), are
+# ignored:
+DAEMON_ENVIRONMENT_VARIABLES = [
+    'USER', 'USERNAME',
+    'GL_USER', 'GL_REPO',
+    'GITEA_PUSHER_NAME', 'GITEA_PUSHER_EMAIL',
+    'GITEA_REPO_USER_NAME', 'GITEA_REPO_NAME',
+    ]
+
+# The largest request accepted by the daemon, in bytes:
+DAEMON_MAX_REQUEST_SIZE = 16 * 1024 * 1024
+
+# The number of seconds the daemon waits for a client to send its
+# request:
+DAEMON_REQUEST_TIMEOUT = 10
+
+# The number of seconds after which the worker of a repository that
+# did not receive any push exits:
+DAEMON_IDLE_TIMEOUT = 300
+
+PUSH_LINE_RE = re.compile(r'^[0-9a-f]{40,64} [0-9a-f]{40,64} \S+$')
+
+
+def check_daemon_support():
+    if not (hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg') and
+            hasattr(os, 'fork')):
+        raise ConfigurationException(
+            'The git-multimail daemon requires Python >= 3.3 on Unix.'
+            )
+
+
+def send_daemon_message(sock, data, fds):
+    """Send data, prefixed by its size, and the file descriptors fds to sock."""
+
+    data = struct.pack('!I', len(data)) + data
+    sent = sock.sendmsg(
+        [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))],
+        )
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+
+def recv_daemon_message(sock, max_fds, max_size=None):
+    """Receive a message sent by send_daemon_message() to sock.
+
+    Return (data, fds), or None if sock is closed before a message
+    starts.  Raise ValueError if the message is incomplete, longer
+    than max_size bytes or comes with more than max_fds file
+    descriptors, after closing the file descriptors received."""
+
+    fds = array.array('i')
+    data = b''
+    size = None
+    try:
+        while size is None or len(data) < size:
+            if size is None:
+                wanted = 4 - len(data)
+            else:
+                wanted = min(size - len(data), 65536)
+            (chunk, ancdata, flags, addr) = sock.recvmsg(
+                wanted, socket.CMSG_SPACE(max_fds * fds.itemsize),
+                )
+            for (level, type, fd_data) in ancdata:
+                if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                    fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+            if flags & socket.MSG_CTRUNC:
+                raise ValueError('too many file descriptors')
+            if not chunk:
+                if size is None and not data and not fds:
+                    return None
+                raise ValueError('incomplete request')
+            data += chunk
+            if size is None and len(data) == 4:
+                (size,) = struct.unpack('!I', data)
+                data = b''
+                if max_size is not None and size > max_size:
+                    raise ValueError('request too large')
+    except Exception:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return (data, list(fds))
+
+
+def parse_daemon_request(data):
+    """Check a request sent by git-multimail-client.
+
+    Return (git_dir, env, input), where git_dir is the real path of
+    the repository, env the variables of DAEMON_ENVIRONMENT_VARIABLES
+    sent with the request and input the standard input of the hook.
+    Raise ValueError if the request is invalid."""
+
+    request = json.loads(data.decode('ascii'))
+    if not isinstance(request, dict):
+        raise ValueError('malformed request')
+    git_dir = request.get('git_dir')
+    if not is_string(git_dir) or not os.path.isabs(git_dir):
+        raise ValueError('invalid repository path')
+    git_dir = os.path.realpath(git_dir)
+    if not (os.path.isfile(os.path.join(git_dir, 'HEAD')) and
+            os.path.isdir(os.path.join(git_dir, 'objects'))):
+        raise ValueError('not a git repository: %s' % (git_dir,))
+    env = request.get('env')
+    if not isinstance(env, dict) or not all(is_string(v) for v in env.values()):
+        raise ValueError('malformed environment')
+    env = dict(
+        (name, env[name]) for name in DAEMON_ENVIRONMENT_VARIABLES if name in env
+        )
+    input = request.get('input')
+    if not is_string(input) or not all(
+            PUSH_LINE_RE.match(line) for line in input.splitlines()
+            ):
+        raise ValueError('malformed standard input')
+    return (git_dir, env, input)
+
+
+class ConfigSnapshot(object):
+    """The configuration of a repository, read again only when it changes.
+
+    The Config is kept from one push to the next until one of the
+    files it was read from, or of the files it could be read from, is
+    modified."""
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.config = None
+        self.files = None
+        self.signature = None
+
+    def _get_files(self):
+        xdg_config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+        files = set([
+            os.path.join(self.git_dir, 'config'),
+            os.path.expanduser('~/.gitconfig'),
+            os.path.join(xdg_config_home, 'git', 'config'),
+            '/etc/gitconfig',
+            ])
+        try:
+            # The origin and the variable alternate in the output:
+            origins = read_git_output(
+                ['config', '--list', '--null', '--show-origin'], keepends=True,
+                ).split('\0')[:-1:2]
+        except CommandError:
+            # git < 2.8 does not know --show-origin.
+            origins = []
+        for origin in origins:
+            if origin.startswith('file:'):
+                files.add(os.path.join(self.git_dir, origin[len('file:'):]))
+        return sorted(files)
+
+    @staticmethod
+    def _get_signature(files):
+        signature = []
+        for path in files:
+            try:
+                st = os.stat(path)
+                signature.append((st.st_mtime, st.st_size, st.st_ino))
+            except OSError:
+                signature.append(None)
+        return signature
+
+    def get(self):
+        """Return the Config of the repository."""
+
+        if self.config is None or self._get_signature(self.files) != self.signature:
+            self.files = self._get_files()
+            self.signature = self._get_signature(self.files)
+            self.config = Config('multimailhook')
+        return self.config
+
+
+def serve_daemon_request(config_snapshot, input, out, err):
+    """Process a push like a post-receive hook.
+
+    input is the standard input of the hook, and out and err are the
+    file descriptors of its standard output and error, which are
+    closed.  Return the exit status of the hook."""
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = (os.dup(1), os.dup(2))
+    os.dup2(out, 1)
+    os.dup2(err, 2)
+    os.close(out)
+    os.close(err)
+    stdin = sys.stdin
+    sys.stdin = io.TextIOWrapper(io.BytesIO(input.encode(ENCODING, 'surrogateescape')))
+    environment = None
+    status = 1
+    try:
+        config = config_snapshot.get()
+        environment = choose_environment(config, osenv=os.environ)
+        environment.detach = False
+        if environment.stdout:
+            mailer = OutputMailer(sys.stdout, environment)
+        else:
+            mailer = choose_mailer(config, environment)
+        run_as_post_receive_hook(environment, mailer)
+        status = 0
+    except ConfigurationException:
+        sys.stderr.write('%s\n' % (sys.exc_info()[1],))
+    except SystemExit:
+        code = sys.exc_info()[1].code
+        if code is None:
+            status = 0
+        elif isinstance(code, int):
+            status = code & 0xff
+        else:
+            sys.stderr.write('%s\n' % (code,))
+    except Exception:
+        report_exception(environment)
+    finally:
+        if environment is not None and environment.logger is not None:
+            environment.logger.close()
+        sys.stdin = stdin
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for (fd, saved_fd) in enumerate(saved_fds, 1):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+    return status
+
+
+def serve_daemon_worker(channel, git_dir, environ):
+    """Process the pushes of git_dir sent by Daemon to channel.
+
+    Pushes are processed one at a time, in the order they were
+    received, until the daemon closes channel.  The environment of
+    each push is environ plus the variables sent by the client.  The
+    configuration (see ConfigSnapshot) and the SMTP connections (see
+    SMTPMailer) are kept from one push to the next."""
+
+    os.environ.clear()
+    os.environ.update(environ)
+    os.environ['GIT_DIR'] = git_dir
+    os.chdir(git_dir)
+    # Wait for the worker started before an idle timeout, and for the
+    # hooks running with multimailhook.detach:
+    lock_repository(git_dir)
+    environ = dict(os.environ)
+    config_snapshot = ConfigSnapshot(git_dir)
+    SMTPMailer.connections = {}
+    while True:
+        message = recv_daemon_message(channel, 3)
+        if message is None:
+            break
+        (data, fds) = message
+        conn = socket.fromfd(fds[0], socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(fds[0])
+        (env, input) = parse_daemon_request(data)[1:]
+        os.environ.clear()
+        os.environ.update(environ)
+        os.environ.update(env)
+        status = serve_daemon_request(config_snapshot, input, fds[1], fds[2])
+        try:
+            conn.sendall(struct.pack('B', status))
+        except socket.error:
+            # The client is gone.
+            pass
+        conn.close()
+    for (smtp, loggedin) in SMTPMailer.connections.values():
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+
+
+class Daemon(object):
+    """Process the pushes forwarded by git-multimail-client.
+
+    The daemon listens on a Unix socket that only its user can
+    connect to; where the system reports the user of the client, the
+    connections of other users are also refused.  A request is made
+    of the path of a repository, the standard input of its
+    post-receive hook and the variables of
+    DAEMON_ENVIRONMENT_VARIABLES, and comes with the standard output
+    and error of the hook.  Everything else, including the
+    configuration and the commands that are run, comes from the
+    repository and from the daemon.
+
+    The pushes of each repository are processed by a worker process
+    (see serve_daemon_worker()), so pushes to one repository are
+    processed one after the other and pushes to different repositories
+    concurrently.  Workers are forked from the daemon, so they do not
+    pay the Python startup, the import of this module and the lookup of
+    the FQDN.  A worker exits once its repository did not receive any
+    push for DAEMON_IDLE_TIMEOUT seconds."""
+
+    def __init__(self, socket_path):
+        check_daemon_support()
+        self.socket_path = socket_path
+        # The environment of the workers: that of the daemon, but
+        # without the variables set by git for the daemon itself, if
+        # any, nor those sent by clients.  The configuration
+        # parameters given to the daemon with -c are kept:
+        self.environ = dict(
+            (name, value) for (name, value) in os.environ.items()
+            if name not in DAEMON_ENVIRONMENT_VARIABLES and
+            (not name.startswith('GIT_') or name == 'GIT_CONFIG_PARAMETERS')
+            )
+        # A map {git_dir: [channel, time of the last push]} for each
+        # running worker:
+        self.workers = {}
+        self.server = None
+
+    def _listen(self):
+        try:
+            if stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                os.unlink(self.socket_path)
+        except OSError:
+            pass
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            self.server.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self.server.listen(16)
+        self.server.settimeout(DAEMON_IDLE_TIMEOUT / 10.0)
+
+    def run(self):
+        get_version()
+        compute_fqdn()
+        self._listen()
+        # Let the workers be reaped automatically:
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        while True:
+            self._expire_workers()
+            try:
+                (conn, addr) = self.server.accept()
+            except socket.timeout:
+                continue
+            try:
+                self._dispatch(conn)
+            except (ValueError, socket.error):
+                sys.stderr.write(
+                    'git_multimail: daemon: request refused: %s\n' % (sys.exc_info()[1],)
+                    )
+            finally:
+                conn.close()
+
+    def _expire_workers(self):
+        now = time.time()
+        for (git_dir, (channel, last_push)) in list(self.workers.items()):
+            if now - last_push > DAEMON_IDLE_TIMEOUT:
+                # The worker exits after processing the pushes already
+                # sent to it:
+                channel.close()
+                del self.workers[git_dir]
+
+    @staticmethod
+    def _check_peer(conn):
+        if not hasattr(socket, 'SO_PEERCRED'):
+            # Rely on the permissions of the socket.
+            return
+        (pid, uid, gid) = struct.unpack(
+            '3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')),
+            )
+        if uid != os.getuid():
+            raise ValueError('connection from user %d' % (uid,))
+
+    def _dispatch(self, conn):
+        """Send the request received on conn to the worker of its repository."""
+
+        self._check_peer(conn)
+        conn.settimeout(DAEMON_REQUEST_TIMEOUT)
+        message = recv_daemon_message(conn, 2, DAEMON_MAX_REQUEST_SIZE)
+        if message is None:
+            return
+        (data, fds) = message
+        try:
+            if len(fds) != 2:
+                raise ValueError('the output of the hook was not sent')
+            try:
+                git_dir = parse_daemon_request(data)[0]
+            except ValueError:
+                os.write(fds[1], str_to_bytes(
+                    'fatal: git_multimail: daemon: %s\n' % (sys.exc_info()[1],)
+                    ))
+                raise
+            for attempt in (1, 2):
+                channel = self._get_worker(git_dir, conn, fds)
+                try:
+                    send_daemon_message(channel, data, [conn.fileno()] + fds)
+                    break
+                except socket.error:
+                    # The worker died; start another one.
+                    del self.workers[git_dir]
+                    channel.close()
+                    if attempt == 2:
+                        raise
+            self.workers[git_dir][1] = time.time()
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _get_worker(self, git_dir, conn, fds):
+        """Return the channel to the worker of git_dir, starting it if needed.
+
+        conn and fds are closed in the new worker, which receives them
+        through the channel like the following requests."""
+
+        if git_dir in self.workers:
+            return self.workers[git_dir][0]
+        (channel, worker_channel) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.fork() == 0:
+            status = 1
+            try:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                for sock in [self.server, conn, channel] + [
+                        worker[0] for worker in self.workers.values()
+                        ]:
+                    sock.close()
+                for fd in fds:
+                    os.close(fd)
+                serve_daemon_worker(worker_channel, git_dir, self.environ)
+                status = 0
+            except:
+                import traceback
+                sys.stderr.write(traceback.format_exc())
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        worker_channel.close()
+        self.workers[git_dir] = [channel, time.time()]
+        return channel
+
+
+def report_exception(environment):
+    """Report the exception being handled as a bug."""
+
+    t, e, tb = sys.exc_info()
+    import traceback
+    sys.stderr.write('\n')  # Avoid mixing message with previous output
+    msg = (
+        'Exception \'' + t.__name__ +
+        '\' raised. Please report this as a bug to\n'
+        'https://github.com/git-multimail/git-multimail/issues\n'
+        'with the information below:\n\n'
+        'git-multimail version ' + get_version() + '\n'
+        'Python version ' + sys.version + '\n' +
+        traceback.format_exc())
+    try:
+        environment.get_logger().error(msg)
+    except:
+        sys.stderr.write(msg)
+
+
 def main(args):
     parser = optparse.OptionParser(
         description=__doc__,
@@ -4266,6 +8080,21 @@ def main(args):
             'detection in this mode.'
             ),
         )
+    parser.add_option(
+        '--deliver-spool', metavar='DIR', action='store', default=None,
+        help=(
+            'Send the emails written to the spool directory DIR when '
+            'multimailhook.mailer is "spool", using the mailer set by '
+            'multimailhook.spoolMailer (default: "sendmail").'
+            ),
+        )
+    parser.add_option(
+        '--daemon', metavar='SOCKET', action='store', default=None,
+        help=(
+            'Run as a daemon processing the pushes forwarded by '
+            'git-multimail-client to the Unix socket SOCKET.'
+            ),
+        )
     parser.add_option(
         '-c', metavar="<name>=<value>", action='append',
         help=(
@@ -4329,6 +8158,13 @@ def main(args):
     if options.c:
         Config.add_config_parameters(options.c)
 
+    if options.daemon:
+        try:
+            Daemon(options.daemon).run()
+        except ConfigurationException:
+            sys.exit(sys.exc_info()[1])
+        return
+
     config = Config('multimailhook')
 
     environment = None
@@ -4345,6 +8181,13 @@ def main(args):
 
         if options.stdout or environment.stdout:
             mailer = OutputMailer(sys.stdout, environment)
+        elif options.deliver_spool:
+            spool_mailer = config.get('spoolmailer', default='sendmail')
+            if spool_mailer == 'spool':
+                raise ConfigurationException(
+                    'multimailhook.spoolMailer cannot be "spool".'
+                    )
+            mailer = make_mailer(config, environment, spool_mailer)
         else:
             mailer = choose_mailer(config, environment)
 
@@ -4353,6 +8196,9 @@ def main(args):
             must_check_setup = False
         if options.check_ref_filter:
             check_ref_filter(environment)
+        elif options.deliver_spool:
+            deliver_spool(environment, mailer, options.deliver_spool,
+                          config.get_int('spoolmaxattempts', default=10))
         elif must_check_setup:
             check_setup(environment)
         # Dual mode: if arguments were specified on the command line, run
@@ -4372,21 +8218,7 @@ def main(args):
     except SystemExit:
         raise
     except Exception:
-        t, e, tb = sys.exc_info()
-        import traceback
-        sys.stderr.write('\n')  # Avoid mixing message with previous output
-        msg = (
-            'Exception \'' + t.__name__ +
-            '\' raised. Please report this as a bug to\n'
-            'https://github.com/git-multimail/git-multimail/issues\n'
-            'with the information below:\n\n'
-            'git-multimail version ' + get_version() + '\n'
-            'Python version ' + sys.version + '\n' +
-            traceback.format_exc())
-        try:
-            environment.get_logger().error(msg)
-        except:
-            sys.stderr.write(msg)
+        report_exception(environment)
         sys.exit(1)
 
 
@@ -53,5 +53,5 @@ setup(
     license='GPLv2',
     package_dir={'': 'git-multimail'},
     py_modules=['git_multimail'],
-    scripts=['git-multimail/git_multimail.py'],
+    scripts=['git-multimail/git_multimail.py', 'git-multimail/git-multimail-client'],
     )
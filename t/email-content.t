@@ -121,6 +121,172 @@ test_email_content 'HTML messages' html '
 	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html
 '
 
+test_email_content 'HTML messages rendered concurrently' html '
+	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html \
+		-c multimailhook.renderJobs=3
+'
+
+test_email_content 'HTML messages sent in background' html '
+	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html \
+		-c multimailhook.sendInBackground=true
+'
+
+test_email_content 'HTML messages spooled, then delivered' html '
+	rm -rf ../spool &&
+	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html \
+		-c multimailhook.mailer=spool -c multimailhook.spoolDir=../spool &&
+	test $(ls ../spool/new | wc -l) = 3 &&
+	"$PYTHON" "$MULTIMAIL" --deliver-spool ../spool &&
+	test -z "$(find ../spool -type f)"
+'
+
+test_email_content 'HTML messages spooled in the background' html '
+	rm -rf ../spool ../detach.log &&
+	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html \
+		-c multimailhook.mailer=spool -c multimailhook.spoolDir=../spool \
+		-c multimailhook.detach=true -c multimailhook.logFile=../detach.log &&
+	for i in $(seq 100)
+	do
+		test "$(ls ../spool/new 2>/dev/null | wc -l)" = 3 && break
+		sleep 0.1
+	done &&
+	# Keep the output of the background process, but not the timestamped log:
+	grep -v "^[0-9]" ../detach.log &&
+	"$PYTHON" "$MULTIMAIL" --deliver-spool ../spool
+'
+
+test_email_content PYTHON3 'HTML messages processed by the daemon' html '
+	rm -f ../daemon.sock &&
+	{ "$PYTHON" "$MULTIMAIL" --daemon ../daemon.sock 2>../daemon.log & } &&
+	DAEMON_PID=$! &&
+	for i in $(seq 100)
+	do
+		test -S ../daemon.sock && break
+		sleep 0.1
+	done &&
+	ls -l ../daemon.sock | grep -q "^s...------" &&
+	git config multimailhook.commitEmailFormat html &&
+	# Configuration parameters sent by the client are ignored:
+	pecho "$(git rev-parse master^^) $(git rev-parse master) refs/heads/master" |
+	GIT_DIR=.git USER=pushuser GIT_MULTIMAIL_SOCKET=../daemon.sock \
+		GIT_CONFIG_PARAMETERS="'\''multimailhook.emailPrefix=[injected]'\''" \
+		"$PYTHON" "$SHARNESS_TEST_DIRECTORY/../git-multimail/git-multimail-client"
+	status=$?
+	git config --unset multimailhook.commitEmailFormat
+	kill $DAEMON_PID
+	(exit $status)
+'
+
+test_email_content 'HTML messages using a reference snapshot' html '
+	rm -f ../ref-snapshot ../ref-snapshot.log &&
+	MASTER=$(git rev-parse master) &&
+	# Write the snapshot with master at master^^, as before the push:
+	git update-ref refs/heads/master master^^ &&
+	test_update refs/heads/master refs/heads/master \
+		-c multimailhook.refSnapshotFile=../ref-snapshot >/dev/null 2>&1 &&
+	git update-ref refs/heads/master $MASTER &&
+	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html \
+		-c multimailhook.refSnapshotFile=../ref-snapshot \
+		-c multimailhook.debugLogFile=../ref-snapshot.log &&
+	grep -q "excluding [0-9]* tips" ../ref-snapshot.log &&
+	grep -q "^tip $MASTER$" ../ref-snapshot
+'
+
+test_expect_success 'reference snapshot changed outside of the hook' '
+	rm -f ../ref-snapshot.log &&
+	test_when_finished "git update-ref -d refs/heads/outside" &&
+	git update-ref refs/heads/outside master^ &&
+	test_update refs/heads/master refs/heads/master^^ \
+		-c multimailhook.refSnapshotFile=../ref-snapshot \
+		-c multimailhook.debugLogFile=../ref-snapshot.log >/dev/null &&
+	grep -q "missing or stale" ../ref-snapshot.log &&
+	grep -q " refs/heads/outside$" ../ref-snapshot
+'
+
+test_email_content 'HTML messages with bitmap index and commit-graph' html '
+	git_objects=$(git rev-parse --git-path objects) &&
+	rm -f ../bitmap-debug.log &&
+	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html \
+		-c multimailhook.useBitmapIndex=true -c multimailhook.writeCommitGraph=true \
+		-c multimailhook.debugLogFile=../bitmap-debug.log &&
+	# The commit-graph is written in the background:
+	for i in $(seq 100)
+	do
+		test -f "$git_objects"/info/commit-graphs/commit-graph-chain && break
+		sleep 0.1
+	done &&
+	test -f "$git_objects"/info/commit-graphs/commit-graph-chain &&
+	grep -q "commit-graph is missing" ../bitmap-debug.log
+'
+
+test_expect_success 'discarded commits counted with the bitmap index' '
+	test_when_finished "rm -f ../bitmap-debug.log" &&
+	test_rewind refs/heads/master refs/heads/master^^ \
+		-c multimailhook.useBitmapIndex=true \
+		-c multimailhook.debugLogFile=../bitmap-debug.log >/dev/null &&
+	grep "2 discarded commits (counted with --use-bitmap-index)" ../bitmap-debug.log
+'
+
+test_expect_success 'commit-graph not rewritten after a few loose objects' '
+	test_when_finished "rm -f ../stale-debug.log" &&
+	echo loose | git hash-object -w --stdin &&
+	test_update refs/heads/master refs/heads/master^^ \
+		-c multimailhook.writeCommitGraph=true \
+		-c multimailhook.debugLogFile=../stale-debug.log >/dev/null &&
+	grep "commit-graph is present" ../stale-debug.log &&
+	! grep "writing it" ../stale-debug.log
+'
+
+test_expect_success 'commit-graph rewritten after many loose objects' '
+	git_objects=$(git rev-parse --git-path objects) &&
+	test_when_finished "rm -rf \"$git_objects\"/info/commit-graphs ../stale-debug.log ../loose" &&
+	mkdir ../loose &&
+	for i in $(seq 1000)
+	do
+		echo $i >../loose/$i || return 1
+	done &&
+	ls ../loose/* | git hash-object -w --stdin-paths >/dev/null &&
+	test_update refs/heads/master refs/heads/master^^ \
+		-c multimailhook.writeCommitGraph=true \
+		-c multimailhook.debugLogFile=../stale-debug.log >/dev/null &&
+	grep "commit-graph is stale, writing it in the background" ../stale-debug.log
+'
+
+test_email_content 'HTML messages using a commit cache' html '
+	rm -f ../commit-cache* &&
+	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html \
+		-c multimailhook.cacheFile=../commit-cache >/dev/null 2>&1 &&
+	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html \
+		-c multimailhook.cacheFile=../commit-cache -c multimailhook.cacheSize=1 &&
+	test "$("$PYTHON" -c "import sqlite3; print(sqlite3.connect(\"../commit-cache\").execute(\"SELECT COUNT(*) FROM commits\").fetchone()[0])")" = 1
+'
+
+test_email_content 'HTML messages not announced twice' html '
+	rm -f ../announced* &&
+	# Commits announced to another list must still be announced:
+	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html \
+		-c multimailhook.commitList="Other List <other@example.com>" \
+		-c multimailhook.announcedCommitsFile=../announced >/dev/null 2>&1 &&
+	test_update refs/heads/master refs/heads/master^^ -c multimailhook.commitEmailFormat=html \
+		-c multimailhook.announcedCommitsFile=../announced &&
+	test_update refs/heads/master refs/heads/master^^ \
+		-c multimailhook.announcedCommitsFile=../announced \
+		-c multimailhook.announcedCommitsMaxAge=30 >../announced.out 2>&1 &&
+	test "$(grep -c "^Subject:" ../announced.out)" = 1 &&
+	test "$(grep -c "^notified " ../announced.out)" = 2
+'
+
+test_email_content 'rebased commits' rebased '
+	# Commit the changes of feature^ and feature again, with other
+	# messages, and then a commit reverting them:
+	export GIT_AUTHOR_DATE="2013-01-01 00:00 +0000" &&
+	export GIT_COMMITTER_DATE="2013-01-01 00:00 +0000" &&
+	c1=$(echo "f4 again" | git commit-tree feature^^{tree} -p feature^^) &&
+	c2=$(echo "f5 again" | git commit-tree feature^{tree} -p $c1) &&
+	c3=$(echo "Revert f4 and f5" | git commit-tree feature^^^{tree} -p $c2) &&
+	test_rewind refs/heads/feature $c3 -c multimailhook.detectRebases=true
+'
+
 test_email_content 'message including a URL' url '
 	test_update refs/heads/master refs/heads/master^ \
 		-c multimailhook.commitBrowseURL="https://github.com/git-multimail/git-multimail/commit/%(id)s" \
@@ -210,6 +376,31 @@ test_email_content 'restrict email count and size' max '
 		-c multimailhook.subjectMaxLength=0
 '
 
+test_email_content 'digest instead of commit emails' max-digest '
+	verbose_do test_update refs/heads/master foo \
+		-c multimailhook.refFilterDontSendRegex=^refs/heads/feature$ \
+		-c multimailhook.maxCommitEmails=4 \
+		-c multimailhook.maxCommitEmailsAction=digest
+'
+
+test_expect_success 'digest using a commit cache' '
+	test_when_finished "rm -f ../digest-cache* ../digest*.out" &&
+	# The emails must be the same, except for their dates and ids:
+	digest_update () {
+		test_update refs/heads/master foo \
+			-c multimailhook.maxCommitEmails=4 \
+			-c multimailhook.maxCommitEmailsAction=digest "$@" 2>&1 |
+		grep -v "^Date:\|^Message-ID:\|^In-Reply-To:\|^References:\|^Thread-Index:"
+	} &&
+	digest_update >../digest.out &&
+	for i in 1 2
+	do
+		digest_update -c multimailhook.cacheFile=../digest-cache >../digest-cached.out &&
+		test_cmp ../digest.out ../digest-cached.out || return 1
+	done &&
+	test "$("$PYTHON" -c "import sqlite3; print(sqlite3.connect(\"../digest-cache\").execute(\"SELECT COUNT(*) FROM commits WHERE numstat IS NOT NULL\").fetchone()[0])")" -gt 0
+'
+
 test_email_content 'refFilter inclusion/exclusion/doSend/DontSend' ref-filter '
 	echo "** Expected below: error" &&
 	verbose_do test_must_fail test_update refs/heads/master refs/heads/master^^ -c multimailhook.refFilterExclusionRegex=^refs/heads/master$ -c multimailhook.refFilterInclusionRegex=whatever &&